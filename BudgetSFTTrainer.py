@@ -0,0 +1,26 @@
+from Dataset import TokenBudgetSampler
+from torch.utils.data import DataLoader
+from transformers.trainer_utils import seed_worker
+from trl import SFTTrainer
+
+class BudgetSFTTrainer(SFTTrainer):
+    def __init__(self, tokenBudget: int, **kwargs):
+        super().__init__(**kwargs)
+        self.tokenBudget = tokenBudget
+    
+    def get_train_dataloader(self):
+        # Batches are formed by a token budget instead of a fixed number of examples
+        trainDataset = self.train_dataset
+        if self.args.remove_unused_columns:
+            trainDataset = self._remove_unused_columns(trainDataset, description = "training")
+        
+        # Batches have no fixed size, accelerate cannot pad the last round of batches. The sampler drops it instead
+        self.accelerator.even_batches = False
+        return self.accelerator.prepare(DataLoader(
+                trainDataset,
+                batch_sampler = TokenBudgetSampler(trainDataset, self.tokenBudget, self.args.seed, self.accelerator.num_processes),
+                collate_fn = self.data_collator,
+                num_workers = self.args.dataloader_num_workers,
+                pin_memory = self.args.dataloader_pin_memory,
+                persistent_workers = self.args.dataloader_persistent_workers,
+                worker_init_fn = seed_worker))
@@ -1,16 +1,29 @@
 import configparser
+import os
 import torch
 
+from accelerate import PartialState
 from peft import PeftModel
+from Profiler import Profiler
 from sympy.printing import str
 
 class Context:
-    model: PeftModel
+    model: PeftModel = None
+    profiler: Profiler
+    results: dict
     
     accel: bool
     device: str
+    worldSize: int
+    rank: int
+    localRank: int
+    mainProcess: bool
     purgeTargetDirectories: bool
     showChatTemplate: bool
+    showModel: bool
+    fastModelLoad: bool
+    cpuThreads: int
+    cpuInteropThreads: int
     
     locBaseModel: str
     locDataset: str
@@ -33,6 +46,13 @@ class Context:
     trPacking: bool
     trOptim : str
     trSchedulerType: str
+    trMaxSteps: int
+    trSaveSteps: int
+    trSaveTotalLimit: int
+    trResume: bool
+    trFsdp: str
+    trTokenBudget: int
+    trTokensPerStep: int
     
     qLora : bool
     loraR: int
@@ -47,22 +67,82 @@ class Context:
     vAbortOnFail: bool
     vPasses: int
     vGenMaxTokens: int
+    vBatchSize: int
+    vDoSample: bool
+    vGraderBatchSize: int
+    vGradingCache: bool
+    vGradingCacheSize: int
+    vAdapters: list
+    vStagedGrading: bool
+    vPrefixCache: bool
+    vCpuInt8: bool
+    vCompile: bool
+    vCpuBenchmark: bool
+    vStops: dict
+    vGraderStopJson: bool
+    vOverlapGrading: bool
+    vGradingQueueSize: int
+    vSimilarity: float
+    vSteps: int
+    vSubsetSize: int
+    vPatience: int
+    vMinDelta: int
+    vMaxRuns: int
+    vMaxMinutes: float
     vExpected: int
     vQuantModel: bool
     vQuantGrader: bool
     vGraderOnCpu: bool
     
+    dsCache: bool
+    locDatasetCache: str
+    dsStreaming: bool
+    dsShuffleBuffer: int
+    dsPacking: bool
+    dsPackingBuffer: int
+    dsNumProc: int
+    dsBatchSize: int
+    dsTokenizerParallelism: str
+    
     mergeFull: bool
+    mergeStreaming: bool
+    mergeDtype: str
+    mergeWorkers: int
     
-    def load(self, cfgFile):
+    def load(self, cfgFile, overrides: dict = None):
         cfg = configparser.ConfigParser()
         if not cfg.read(cfgFile):
             raise Exception("Cannot read configuration file: " + cfgFile)
+        for key, value in (overrides or {}).items():
+            sections = [section for section in cfg.sections() if cfg.has_option(section, key)]
+            if len(sections) == 0:
+                raise Exception("Unknown configuration key: " + key)
+            cfg.set(sections[0], key, value)
         
         self.accel = torch.cuda.is_available() and cfg.get("Operation", "device") != "cpu"
         self.device = (cfg.get("Operation", "device") if self.accel else "cpu") or "cpu"
+        # Launched by torchrun or accelerate launch: one process per device, on cpu the processes communicate via gloo
+        self.worldSize = int(os.environ.get("WORLD_SIZE", "1"))
+        self.rank = 0
+        self.localRank = 0
+        if self.worldSize > 1:
+            state = PartialState(backend = "nccl" if self.accel else "gloo")
+            self.rank = state.process_index
+            self.localRank = state.local_process_index
+            if self.accel:
+                self.device = f"cuda:{self.localRank}"
+        self.mainProcess = self.rank == 0
         self.purgeTargetDirectories = cfg.get("Operation", "purgeTargetDirectories").lower() == "true"
         self.showChatTemplate = cfg.get("Operation", "showChatTemplate").lower() == "true"
+        self.showModel = cfg.get("Operation", "showModel", fallback = "false").lower() == "true"
+        self.fastModelLoad = cfg.get("Operation", "fastModelLoad", fallback = "true").lower() == "true"
+        self.cpuThreads = int(cfg.get("Operation", "cpuThreads", fallback = "") or "0") or None
+        self.cpuInteropThreads = int(cfg.get("Operation", "cpuInteropThreads", fallback = "") or "0") or None
+        if self.cpuThreads:
+            torch.set_num_threads(self.cpuThreads)
+        # The inter-op thread pool can only be sized once, before its first use
+        if self.cpuInteropThreads and torch.get_num_interop_threads() != self.cpuInteropThreads:
+            torch.set_num_interop_threads(self.cpuInteropThreads)
         
         self.locBaseModel = cfg.get("Trainer", "locBaseModel")
         self.locDataset = cfg.get("Trainer", "locDataset")
@@ -87,6 +167,14 @@ class Context:
         self.trPacking = cfg.get("Trainer", "trPacking").lower() == "true"
         self.trOptim = cfg.get("Trainer", "trOptim") or None
         self.trSchedulerType = cfg.get("Trainer", "trSchedulerType") or None
+        self.trMaxSteps = int(cfg.get("Trainer", "trMaxSteps", fallback = "") or "0") or None
+        self.trSaveSteps = int(cfg.get("Trainer", "trSaveSteps", fallback = "") or "0") or None
+        # Empty keeps 2 checkpoints, 0 keeps all of them
+        self.trSaveTotalLimit = int(cfg.get("Trainer", "trSaveTotalLimit", fallback = "") or "2") or None
+        self.trResume = cfg.get("Trainer", "trResume", fallback = "true").lower() == "true"
+        self.trFsdp = cfg.get("Trainer", "trFsdp", fallback = "") or None
+        self.trTokenBudget = int(cfg.get("Trainer", "trTokenBudget", fallback = "") or "0") or None
+        self.trTokensPerStep = int(cfg.get("Trainer", "trTokensPerStep", fallback = "") or "0") or None
         
         self.qLora = cfg.get("Lora", "qLora").lower() == "true"
         self.loraR = int(cfg.get("Lora", "loraR") or "0") or 64
@@ -101,11 +189,90 @@ class Context:
         self.vAbortOnFail = cfg.get("Validation", "vAbortOnFail").lower() == "true"
         self.vPasses = int(cfg.get("Validation", "vPasses") or "0") or 10
         self.vGenMaxTokens = int(cfg.get("Validation", "vGenMaxTokens") or "0") or 100
+        self.vBatchSize = int(cfg.get("Validation", "vBatchSize", fallback = "") or "0") or 8
+        self.vDoSample = cfg.get("Validation", "vDoSample", fallback = "true").lower() == "true"
         self.vExpected = int(cfg.get("Validation", "vExpected") or "0") or 70
         self.vQuantModel = cfg.get("Validation", "vQuantModel").lower() == "true"
         self.vQuantGrader = cfg.get("Validation", "vQuantGrader").lower() == "true"
         self.vGraderOnCpu = cfg.get("Validation", "vGraderOnCpu").lower() == "true"
+        self.vGraderBatchSize = int(cfg.get("Validation", "vGraderBatchSize", fallback = "") or "0") or 8
+        self.vGradingCache = cfg.get("Validation", "vGradingCache", fallback = "true").lower() == "true"
+        self.vGradingCacheSize = int(cfg.get("Validation", "vGradingCacheSize", fallback = "") or "0") or 100000
+        self.vAdapters = [adapter.strip() for adapter in cfg.get("Validation", "vAdapters", fallback = "").split(",") if adapter.strip()]
+        self.vOverlapGrading = cfg.get("Validation", "vOverlapGrading", fallback = "true").lower() == "true"
+        self.vGradingQueueSize = int(cfg.get("Validation", "vGradingQueueSize", fallback = "") or "0") or 64
+        # Stop strings are separated by |, \n and \t are unescaped
+        self.vStops = {promptType: [stop.replace("\\n", "\n").replace("\\t", "\t") for stop in cfg.get("Validation", key, fallback = "").split("|") if stop]
+                       for promptType, key in (("chat", "vStopChat"), ("chatCompletion", "vStopChatCompletion"), ("completion", "vStopCompletion"))}
+        self.vGraderStopJson = cfg.get("Validation", "vGraderStopJson", fallback = "true").lower() == "true"
+        self.vCpuInt8 = cfg.get("Validation", "vCpuInt8", fallback = "true").lower() == "true"
+        self.vCompile = cfg.get("Validation", "vCompile", fallback = "false").lower() == "true"
+        self.vCpuBenchmark = cfg.get("Validation", "vCpuBenchmark", fallback = "false").lower() == "true"
+        self.vPrefixCache = cfg.get("Validation", "vPrefixCache", fallback = "true").lower() == "true"
+        self.vStagedGrading = cfg.get("Validation", "vStagedGrading", fallback = "false").lower() == "true"
+        self.vSimilarity = float(cfg.get("Validation", "vSimilarity", fallback = "") or "0.5")
+        self.vSteps = int(cfg.get("Validation", "vSteps", fallback = "") or "0") or None
+        self.vSubsetSize = int(cfg.get("Validation", "vSubsetSize", fallback = "") or "0") or None
+        self.vPatience = int(cfg.get("Validation", "vPatience", fallback = "") or "0") or None
+        self.vMinDelta = int(cfg.get("Validation", "vMinDelta", fallback = "") or "1")
+        # Bounded by default, otherwise the loop never ends when vExpected is not reached. 0 removes the bound
+        self.vMaxRuns = int(cfg.get("Validation", "vMaxRuns", fallback = "") or "10") or None
+        self.vMaxMinutes = float(cfg.get("Validation", "vMaxMinutes", fallback = "") or "0") or None
+        
+        self.dsCache = cfg.get("Dataset", "dsCache", fallback = "true").lower() == "true"
+        self.locDatasetCache = cfg.get("Dataset", "locDatasetCache", fallback = "") or None
+        self.dsStreaming = cfg.get("Dataset", "dsStreaming", fallback = "false").lower() == "true"
+        self.dsShuffleBuffer = int(cfg.get("Dataset", "dsShuffleBuffer", fallback = "") or "0") or 10000
+        self.dsPacking = cfg.get("Dataset", "dsPacking", fallback = "false").lower() == "true"
+        self.dsPackingBuffer = int(cfg.get("Dataset", "dsPackingBuffer", fallback = "") or "0") or 10000
+        self.dsNumProc = int(cfg.get("Dataset", "dsNumProc", fallback = "") or "0") or None
+        self.dsBatchSize = int(cfg.get("Dataset", "dsBatchSize", fallback = "") or "0") or 250
+        self.dsTokenizerParallelism = (cfg.get("Dataset", "dsTokenizerParallelism", fallback = "") or "auto").lower()
+        if self.dsTokenizerParallelism not in ("auto", "true", "false"):
+            raise Exception("dsTokenizerParallelism must be one of auto, true, false")
+        if self.dsStreaming and not self.trMaxSteps:
+            raise Exception("dsStreaming requires trMaxSteps")
+        if self.trTokenBudget and self.dsStreaming:
+            raise Exception("trTokenBudget requires the example lengths, it does not support dsStreaming")
+        if self.trFsdp and self.validate and self.vInplace:
+            raise Exception("trFsdp does not support vInplace, the sharded model cannot generate on the main process alone")
         
         self.mergeFull = cfg.get("Merger", "mergeFull").lower() == "true"
+        self.mergeStreaming = cfg.get("Merger", "mergeStreaming", fallback = "false").lower() == "true"
+        self.mergeDtype = cfg.get("Merger", "mergeDtype", fallback = "").lower() or None
+        if self.mergeDtype and self.mergeDtype not in ("bf16", "fp16", "fp32"):
+            raise Exception("mergeDtype must be one of bf16, fp16, fp32")
+        self.mergeWorkers = int(cfg.get("Merger", "mergeWorkers", fallback = "") or "0") or 1
         
         print(self.__dict__)
+        
+        self.profiler = Profiler()
+        self.results = {}
+    
+    def barrier(self):
+        if self.worldSize > 1:
+            torch.distributed.barrier()
+    
+    def broadcast(self, value):
+        # Decisions of the main process, e.g. validation results, are shared with all processes
+        if self.worldSize == 1:
+            return value
+        values = [value]
+        torch.distributed.broadcast_object_list(values, src = 0)
+        return values[0]
+    
+    def availableMemory(self, onAccel: bool = False):
+        # Free memory of the accelerator or available host memory in bytes, 0 when it cannot be determined
+        if onAccel:
+            return torch.cuda.mem_get_info(torch.device(self.device))[0]
+        try:
+            with open("/proc/meminfo", 'r') as file:
+                for line in file:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return 0
@@ -1,45 +1,177 @@
+import bisect
+import hashlib
+import os
 import pathlib
+import random
+import shutil
+import time
+import numpy
+import pyarrow
+import pyarrow.compute
+import torch
 
+from concurrent.futures import ThreadPoolExecutor
 from Context import Context
-from datasets import load_dataset, concatenate_datasets
+from datasets import DatasetDict, load_dataset, load_from_disk, concatenate_datasets, IterableDataset
+from datasets import Dataset as HfDataset
+from datasets.table import InMemoryTable
 
 from datasets import disable_caching
 disable_caching()
 
+# Bump when the encoders change, so cached shards from older versions are not reused
+CACHE_VERSION = 2
+
+# Memory assumed per encoding worker process when the worker count is detected automatically
+WORKER_MEMORY = 1 << 30
+
 class Dataset:
+    numProc = 1
+    # Datasets scanned by this process, e.g. reused by the variants of a sweep
+    scanned = {}
+    
     def scan(self, location: str, tokenizer, context: Context):
+        scanKey = None
+        if not context.dsStreaming:
+            scanKey = self.__scanKey(location, tokenizer, context)
+            if scanKey in self.scanned:
+                print(f"Reusing scanned dataset directory {location}")
+                return self.scanned[scanKey]
+        
+        with context.profiler.stage("dataset scan"):
+            dataset = self.__scan(location, tokenizer, context)
+        if scanKey != None:
+            self.scanned[scanKey] = dataset
+        return dataset
+    
+    def __scanKey(self, location: str, tokenizer, context: Context):
+        key = hashlib.sha256(self.__cacheIdentity(tokenizer, self.__customChatTemplate(context), context).encode("utf-8"))
+        key.update(f"{context.dsPacking}".encode("utf-8"))
+        for file in sorted(f for f in pathlib.Path(location).rglob("*") if f.is_file()):
+            stat = file.stat()
+            key.update(f"{file.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+        return key.hexdigest()
+    
+    def __customChatTemplate(self, context: Context):
+        if context.locCustomPromptTemplate == None:
+            return None
+        with open(context.locCustomPromptTemplate, 'r') as file:
+            return file.read()
+    
+    def __scan(self, location: str, tokenizer, context: Context):
         print(f"Scanning dataset directory {location}")
+        
+        self.__configureParallelism(context)
 
-        customChatTemplate = None
-        if context.locCustomPromptTemplate != None:
-            with open(context.locCustomPromptTemplate, 'r') as file:
-                customChatTemplate = file.read()
+        customChatTemplate = self.__customChatTemplate(context)
+        
+        cacheIdentity = None
+        if context.dsCache and not context.dsStreaming:
+            cacheIdentity = self.__cacheIdentity(tokenizer, customChatTemplate, context)
         
         datasets = []
+        weights = []
+        # Encoded datasets per file, they are concatenated in file order whether they come from the cache or not
+        encodedFiles = {}
         directory = pathlib.Path(location)
-        files = [f for f in directory.iterdir() if f.is_file()]
+        files = sorted(f for f in directory.rglob("*") if f.is_file() and self.__fileType(f) != None)
+        
+        pending = []
         for file in files:
-            print(file.name)
+            cacheKey = None
+            if cacheIdentity != None:
+                cacheKey = self.__cacheKey(file, cacheIdentity)
+                cached = self.__loadCached(cacheKey, context)
+                if cached != None:
+                    print(f"{file.relative_to(directory)}: reusing cached dataset {cacheKey}")
+                    encodedFiles[file] = cached
+                    continue
+            pending.append((file, cacheKey))
+        
+        # Files are loaded concurrently and encoded together per file type and schema, so many small files
+        # don't each pay the startup cost of the encoding workers
+        with ThreadPoolExecutor(max_workers = max(1, min(self.numProc, len(pending)))) as executor:
+            loaded = list(executor.map(lambda item: self.loadFile(self.__fileType(item[0]), str(item[0]), context, streaming = context.dsStreaming), pending))
+        
+        groups = {}
+        for (file, cacheKey), dataset in zip(pending, loaded):
+            columns = self.__columns(dataset)
+            kind = self.__kind(columns)
+            if kind == None:
+                print(f"Cannot load dataset {file.relative_to(directory)}, json dataset is malformed")
+                continue
+            groups.setdefault((self.__fileType(file), kind, tuple(sorted(columns))), []).append((file, cacheKey, dataset))
+        
+        for (fileType, kind, columns), members in groups.items():
+            print(f"Encoding {len(members)} {kind} files: {', '.join(str(file.relative_to(directory)) for file, _, _ in members)}")
             
-            if file.name.lower().endswith(".txt"):
-                textDataset = self.loadFile("text", str(file), context)
-                self.__loadTextDataset(textDataset, datasets, tokenizer, context)
-                
-            elif file.name.lower().endswith(".json") or file.name.lower().endswith(".jsonl"):
-                qaDataset = self.loadFile("json", str(file), context)
-                if "text" in qaDataset['train'].features:
-                    self.__loadTextDataset(qaDataset, datasets, tokenizer, context)
-                elif "history" in qaDataset['train'].features or "instruct" in qaDataset['train'].features or "completion" in qaDataset['train'].features or "question" in qaDataset['train'].features or "answer" in qaDataset['train'].features:
-                    self.__loadQaDataset(qaDataset, datasets, tokenizer, customChatTemplate, context)
-                elif "conversation" in qaDataset['train'].features:
-                    self.__loadConversationDataset(qaDataset, datasets, tokenizer, customChatTemplate, context)
-                else:
-                    print("Cannot load dataset, json dataset is malformed")
+            startTime = time.perf_counter()
+            if context.dsStreaming:
+                group = self.loadFile(fileType, [str(file) for file, _, _ in members], context, streaming = True)
+                self.__encode(kind, group, datasets, tokenizer, customChatTemplate, context)
+                weights.append(sum(max(file.stat().st_size, 1) for file, _, _ in members))
+            else:
+                group = DatasetDict({"train": concatenate_datasets([dataset["train"].add_column("__source", [i] * dataset["train"].num_rows) for i, (_, _, dataset) in enumerate(members)])})
+                encoded = []
+                self.__encode(kind, group, encoded, tokenizer, customChatTemplate, context)
+                self.__split(encoded[0], members, encodedFiles, time.perf_counter() - startTime, directory, context)
         
+        if not context.dsStreaming:
+            datasets = [encodedFiles[file] for file in files if file in encodedFiles]
         if len(datasets) == 0:
             raise Exception("No datasets have been found. Check configuration")
         
-        return concatenate_datasets(datasets).shuffle(seed = 4711)
+        if context.dsStreaming:
+            dataset = self.__interleave(datasets, weights, context)
+            if context.dsPacking:
+                dataset = self.__packStream(dataset, context)
+            return dataset
+        
+        dataset = concatenate_datasets(datasets)
+        if context.dsPacking:
+            dataset = self.__pack(dataset, context)
+        return dataset.shuffle(seed = 4711)
+    
+    def __fileType(self, file: pathlib.Path):
+        if file.name.lower().endswith(".txt"):
+            return "text"
+        elif file.name.lower().endswith(".json") or file.name.lower().endswith(".jsonl"):
+            return "json"
+        return None
+    
+    def __kind(self, columns):
+        if "text" in columns:
+            return "text"
+        elif "history" in columns or "instruct" in columns or "completion" in columns or "question" in columns or "answer" in columns:
+            return "qa"
+        elif "conversation" in columns:
+            return "conversation"
+        return None
+    
+    def __encode(self, kind: str, dataset, datasets, tokenizer, customChatTemplate, context: Context):
+        if kind == "text":
+            self.__loadTextDataset(dataset, datasets, tokenizer, context)
+        elif kind == "qa":
+            self.__loadQaDataset(dataset, datasets, tokenizer, customChatTemplate, context)
+        elif kind == "conversation":
+            self.__loadConversationDataset(dataset, datasets, tokenizer, customChatTemplate, context)
+    
+    def __split(self, encoded, members, encodedFiles: dict, seconds: float, directory: pathlib.Path, context: Context):
+        # Encoded rows keep the order of their source files, each file's rows are a contiguous range
+        sources = encoded.with_format("arrow")["__source"].to_numpy()
+        encoded = encoded.remove_columns("__source")
+        bounds = numpy.searchsorted(sources, numpy.arange(len(members) + 1))
+        tokens = numpy.cumsum(numpy.concatenate(([0], self.__lengths(encoded))))
+        for i, (file, cacheKey, _) in enumerate(members):
+            dataset = encoded.select(range(bounds[i], bounds[i + 1]))
+            # The files of a group are encoded together, the group's time is shared by their number of tokens
+            fileTokens = int(tokens[bounds[i + 1]] - tokens[bounds[i]])
+            self.__reportThroughput(file.relative_to(directory), dataset.num_rows, fileTokens, seconds * fileTokens / max(int(tokens[-1]), 1), context)
+            if dataset.num_rows == 0:
+                continue
+            encodedFiles[file] = dataset
+            if cacheKey != None:
+                self.__storeCached(dataset, cacheKey, context)
     
     def loadFile(self, type_: str, path: str, context: Context, **kwargs):
         return self.__load(type_, context, data_files=path, **kwargs)
@@ -55,6 +187,222 @@ class Dataset:
         
         return dataset
     
+    def __columns(self, dataset):
+        # Streamed json files don't know their features before the first record has been read
+        columns = dataset["train"].column_names
+        if columns == None:
+            columns = list(next(iter(dataset["train"])).keys())
+        return columns
+    
+    def __interleave(self, datasets, weights, context: Context):
+        # Files are drawn from in proportion to their remaining size, so all of them run out at about the
+        # same time and every example is still seen exactly once per epoch
+        def generate():
+            rnd = random.Random(4711)
+            iterators = [iter(dataset) for dataset in datasets]
+            remaining = list(weights)
+            while len(iterators) > 0:
+                i = rnd.choices(range(len(iterators)), weights = remaining)[0]
+                try:
+                    yield next(iterators[i])
+                except StopIteration:
+                    del iterators[i]
+                    del remaining[i]
+        
+        return IterableDataset.from_generator(generate).shuffle(seed = 4711, buffer_size = context.dsShuffleBuffer)
+    
+    def __binPack(self, lengths, capacity):
+        # Best-fit decreasing: longest examples first, each one into the fullest bin that still has room.
+        # Examples longer than the capacity get a bin of their own
+        bins = []
+        free = []
+        for i in sorted(range(len(lengths)), key = lambda i: -lengths[i]):
+            pos = bisect.bisect_left(free, (lengths[i], -1))
+            if pos < len(free):
+                remaining, binNo = free.pop(pos)
+                bins[binNo].append(i)
+                if remaining > lengths[i]:
+                    bisect.insort(free, (remaining - lengths[i], binNo))
+            else:
+                bins.append([i])
+                if capacity > lengths[i]:
+                    bisect.insort(free, (capacity - lengths[i], len(bins) - 1))
+        return bins
+    
+    def __pack(self, dataset, context: Context):
+        print("Packing dataset...")
+        
+        lengths = self.__lengths(dataset)
+        bins = self.__binPack(lengths.tolist(), context.trMaxSeqLength)
+        
+        order = [i for packed in bins for i in packed]
+        inputIds = dataset.select(order).with_format("arrow")["input_ids"]
+        if isinstance(inputIds, pyarrow.ChunkedArray):
+            inputIds = inputIds.combine_chunks()
+        values = inputIds.flatten()
+        
+        # position ids restart at 0 for each example, they mark the example boundaries within a packed sequence
+        orderedLengths = lengths[order]
+        exampleStarts = numpy.cumsum(orderedLengths) - orderedLengths
+        positionIds = numpy.arange(len(values), dtype = numpy.int64) - numpy.repeat(exampleStarts, orderedLengths)
+        
+        binLengths = numpy.array([sum(lengths[i] for i in packed) for packed in bins], dtype = numpy.int64)
+        offsets = numpy.concatenate(([0], numpy.cumsum(binLengths)))
+        # 32 bit list offsets overflow beyond 2^31 tokens
+        listArray = pyarrow.ListArray
+        if offsets[-1] >= 2**31:
+            listArray = pyarrow.LargeListArray
+        offsets = pyarrow.array(offsets, type = pyarrow.int64() if listArray == pyarrow.LargeListArray else pyarrow.int32())
+        
+        table = pyarrow.table({
+            "input_ids": listArray.from_arrays(offsets, values),
+            "position_ids": listArray.from_arrays(offsets, pyarrow.array(positionIds))
+        })
+        
+        self.__reportPacking(len(lengths), len(bins), int(binLengths.sum()), context)
+        
+        return HfDataset(InMemoryTable(table))
+    
+    def __packStream(self, dataset, context: Context):
+        # Streamed examples are packed within a bounded window of dsPackingBuffer examples
+        def generate():
+            buffer = []
+            cntExamples = 0
+            cntBins = 0
+            cntTokens = 0
+            for example in dataset:
+                buffer.append(example["input_ids"])
+                if len(buffer) >= context.dsPackingBuffer:
+                    cntExamples += len(buffer)
+                    for packed in self.__packBuffer(buffer, context):
+                        cntBins += 1
+                        cntTokens += len(packed["input_ids"])
+                        yield packed
+                    buffer = []
+            if len(buffer) > 0:
+                cntExamples += len(buffer)
+                for packed in self.__packBuffer(buffer, context):
+                    cntBins += 1
+                    cntTokens += len(packed["input_ids"])
+                    yield packed
+            self.__reportPacking(cntExamples, cntBins, cntTokens, context)
+        
+        return IterableDataset.from_generator(generate)
+    
+    def __packBuffer(self, buffer, context: Context):
+        for packed in self.__binPack([len(inputIds) for inputIds in buffer], context.trMaxSeqLength):
+            inputIds = []
+            positionIds = []
+            for i in packed:
+                inputIds.extend(buffer[i])
+                positionIds.extend(range(len(buffer[i])))
+            yield {"input_ids": inputIds, "position_ids": positionIds}
+    
+    def __reportPacking(self, cntExamples, cntBins, cntTokens, context: Context):
+        efficiency = float(cntTokens) / float(max(cntBins, 1) * context.trMaxSeqLength) * 100.0
+        print(f"Packed {cntExamples} examples into {cntBins} sequences of {context.trMaxSeqLength} tokens, efficiency {efficiency:.1f}%")
+    
+    def __map(self, dataset, encoder, removeColumns, context: Context):
+        if "__source" in self.__columns(dataset):
+            encoder = self.__withSource(encoder)
+            removeColumns = [removeColumns] if isinstance(removeColumns, str) else list(removeColumns)
+            if "__source" not in removeColumns:
+                removeColumns.append("__source")
+        
+        if context.dsStreaming:
+            return dataset.map(encoder, batched = True, batch_size = context.dsBatchSize, remove_columns = removeColumns)["train"]
+        
+        # Starting worker processes costs more than encoding a few batches
+        numProc = self.numProc
+        if dataset["train"].num_rows < context.dsBatchSize * numProc:
+            numProc = max(1, dataset["train"].num_rows // context.dsBatchSize)
+        return dataset.map(encoder, batched = True, batch_size = context.dsBatchSize, num_proc = numProc if numProc > 1 else None, remove_columns = removeColumns)["train"]
+    
+    def __withSource(self, encoder):
+        # Runs the encoder per source file within a batch and tags every encoded row with its source
+        def sourcedEncoder(batch):
+            sources = batch["__source"]
+            columns = {key: batch[key] for key in batch.keys() if key != "__source"}
+            result = {"__source": []}
+            start = 0
+            while start < len(sources):
+                end = start
+                while end < len(sources) and sources[end] == sources[start]:
+                    end += 1
+                encoded = encoder({key: values[start:end] for key, values in columns.items()})
+                for key, values in encoded.items():
+                    result.setdefault(key, []).extend(values)
+                result["__source"].extend([sources[start]] * len(encoded["input_ids"]))
+                start = end
+            return result
+        return sourcedEncoder
+    
+    def __configureParallelism(self, context: Context):
+        self.numProc = context.dsNumProc
+        if not self.numProc:
+            cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+            self.numProc = max(1, min(cpus, (context.availableMemory() or WORKER_MEMORY) // WORKER_MEMORY))
+        
+        # The fast tokenizer's own thread pool competes with the worker processes
+        tokenizerParallelism = context.dsTokenizerParallelism
+        if tokenizerParallelism == "auto":
+            tokenizerParallelism = "true" if self.numProc == 1 or context.dsStreaming else "false"
+        os.environ["TOKENIZERS_PARALLELISM"] = tokenizerParallelism
+        
+        print(f"Encoding with {self.numProc} workers, batch size {context.dsBatchSize}, tokenizer parallelism {tokenizerParallelism}")
+    
+    def __lengths(self, dataset):
+        return pyarrow.compute.list_value_length(dataset.with_format("arrow")["input_ids"]).to_numpy()
+    
+    def __reportThroughput(self, file: pathlib.Path, examples: int, tokens: int, seconds: float, context: Context):
+        context.profiler.count(tokens)
+        print(f"{file}: {examples} examples, {tokens} tokens in {seconds:.1f}s ({tokens / max(seconds, 1e-6):.0f} tokens/s)")
+    
+    def __cacheIdentity(self, tokenizer, customChatTemplate, context: Context):
+        identity = hashlib.sha256()
+        identity.update(f"{CACHE_VERSION}:{context.trMaxSeqLength}:{type(tokenizer).__name__}:{tokenizer.name_or_path}:{len(tokenizer)}".encode("utf-8"))
+        identity.update(str(tokenizer.special_tokens_map).encode("utf-8"))
+        identity.update(str(customChatTemplate or tokenizer.chat_template).encode("utf-8"))
+        if tokenizer.is_fast:
+            identity.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+        else:
+            identity.update(str(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+        return identity.hexdigest()
+    
+    def __cacheKey(self, file: pathlib.Path, cacheIdentity: str):
+        key = hashlib.sha256(f"{cacheIdentity}:{file.suffix.lower()}".encode("utf-8"))
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                key.update(chunk)
+        return key.hexdigest()
+    
+    def __cacheLocation(self, cacheKey: str, context: Context):
+        return os.path.join(context.locDatasetCache or os.path.join(context.locWorkdir, "dataset_cache"), cacheKey)
+    
+    def __loadCached(self, cacheKey: str, context: Context):
+        location = self.__cacheLocation(cacheKey, context)
+        if not os.path.isdir(location):
+            return None
+        try:
+            return load_from_disk(location)
+        except Exception as e:
+            print(f"Discarding unreadable dataset cache {location}: {e}")
+            shutil.rmtree(location, ignore_errors = True)
+            return None
+    
+    def __storeCached(self, dataset, cacheKey: str, context: Context):
+        location = self.__cacheLocation(cacheKey, context)
+        # Shards are written aside and renamed, so an interrupted run never leaves a partial entry behind.
+        # Every process writes its own copy, concurrent processes may store the same entry
+        tmpLocation = f"{location}.{os.getpid()}.tmp"
+        shutil.rmtree(tmpLocation, ignore_errors = True)
+        dataset.save_to_disk(tmpLocation)
+        try:
+            os.rename(tmpLocation, location)
+        except OSError:
+            # Another process stored the entry first
+            shutil.rmtree(tmpLocation, ignore_errors = True)
+    
     def __loadTextDataset(self, textDataset, datasets, tokenizer, context):
         def datasetTextEncoder(batch):
             inputIds = []
@@ -68,7 +416,7 @@ class Dataset:
             
             return {"input_ids": inputIds, "attention_mask": attentionMask}
         
-        datasets.append(textDataset.map(datasetTextEncoder, batched = True, batch_size = 250, num_proc = 4, remove_columns="text")["train"])
+        datasets.append(self.__map(textDataset, datasetTextEncoder, "text", context))
     
     def __loadQaDataset(self, qaDataset, datasets, tokenizer, customChatTemplate, context):
         MAPPING = {"history": "assistant",
@@ -94,35 +442,141 @@ class Dataset:
             
             return {"input_ids": inputIds, "attention_mask": attentionMask}
         
-        datasets.append(qaDataset.map(datasetChatEncoder, batched = True, batch_size = 250, num_proc = 4, remove_columns=qaDataset.column_names["train"])["train"])
+        datasets.append(self.__map(qaDataset, datasetChatEncoder, self.__columns(qaDataset), context))
     
     def __loadConversationDataset(self, qaDataset, datasets, tokenizer, customChatTemplate, context):
+        # The template overhead of the active chat template is measured once: a fixed part per chat and a part per turn
+        emptyTurn = [{"role": "user", "content": ""}, {"role": "assistant", "content": ""}]
+        oneTurn = len(tokenizer(self.__render(emptyTurn, tokenizer, customChatTemplate), add_special_tokens = False)['input_ids'])
+        twoTurns = len(tokenizer(self.__render(emptyTurn * 2, tokenizer, customChatTemplate), add_special_tokens = False)['input_ids'])
+        turnOverhead = twoTurns - oneTurn
+        chatOverhead = oneTurn - turnOverhead
+        
         def datasetConversationEncoder(batch):
-            inputIds = []
-            attentionMask = []
+            contents = [turn for records in batch['conversation'] for record in records for turn in (record['user'], record['assistant'])]
+            lengths = iter([len(encoded) for encoded in tokenizer(contents, add_special_tokens = False)['input_ids']])
+            
+            chats = []
             for records in batch['conversation']:
                 chat = []
-                cnt = 0
+                cnt = chatOverhead
                 for record in records:
-                    curCnt = len(tokenizer.tokenize(record['user'])) + len(tokenizer.tokenize(record['assistant'])) + 15
-                    if cnt + curCnt >= context.trMaxSeqLength:
-                        encoded = self.__format(chat, tokenizer, customChatTemplate, context)
-                        inputIds.append(encoded['input_ids'])
-                        attentionMask.append(encoded['attention_mask'])
+                    curCnt = next(lengths) + next(lengths) + turnOverhead
+                    if len(chat) > 0 and cnt + curCnt > context.trMaxSeqLength:
+                        chats.append(chat)
                         chat = []
-                        cnt = curCnt
-                    else:
-                        cnt += curCnt
+                        cnt = chatOverhead
+                    cnt += curCnt
                     chat.append({"role": "user", "content": f"{record['user']}"})
                     chat.append({"role": "assistant", "content": f"{record['assistant']}"})
-                encoded = self.__format(chat, tokenizer, customChatTemplate, context)
-                inputIds.append(encoded['input_ids'])
-                attentionMask.append(encoded['attention_mask'])
+                chats.append(chat)
+            
+            inputIds = []
+            attentionMask = []
+            self.__encodeChats(chats, inputIds, attentionMask, tokenizer, customChatTemplate, context)
             return {"input_ids": inputIds, "attention_mask": attentionMask}
         
-        datasets.append(qaDataset.map(datasetConversationEncoder, batched = True, batch_size = 250, num_proc = 4, remove_columns=qaDataset.column_names["train"])["train"])
+        datasets.append(self.__map(qaDataset, datasetConversationEncoder, self.__columns(qaDataset), context))
+    
+    def __encodeChats(self, chats, inputIds, attentionMask, tokenizer, customChatTemplate, context):
+        texts = [self.__render(chat, tokenizer, customChatTemplate) for chat in chats]
+        if context.showChatTemplate:
+            for text in texts:
+                print(text)
+        
+        encoded = tokenizer(texts, add_special_tokens = False)
+        for chat, ids, mask in zip(chats, encoded['input_ids'], encoded['attention_mask']):
+            if len(ids) <= context.trMaxSeqLength:
+                inputIds.append(ids)
+                attentionMask.append(mask)
+            elif len(chat) > 2:
+                # Tokens merging across turn boundaries can exceed the estimate, split between turns
+                half = len(chat) // 4 * 2
+                self.__encodeChats([chat[:half], chat[half:]], inputIds, attentionMask, tokenizer, customChatTemplate, context)
+            else:
+                inputIds.append(ids[:context.trMaxSeqLength])
+                attentionMask.append(mask[:context.trMaxSeqLength])
+    
+    def __render(self, chat, tokenizer, customChatTemplate):
+        return tokenizer.apply_chat_template(chat, chat_template = customChatTemplate, add_generation_prompt = False, tokenize = False)
     
     def __format(self, chat, tokenizer, customChatTemplate, context):
         if context.showChatTemplate:
             print(tokenizer.apply_chat_template(chat, chat_template = customChatTemplate, add_generation_prompt = False, tokenize = False, return_dict = False))
         return tokenizer.apply_chat_template(chat, chat_template = customChatTemplate, add_generation_prompt = False, tokenize = True, return_dict = True)
+
+class PackedDataCollator:
+    def __init__(self, padTokenId: int, attnImplementation: str, dtype):
+        self.padTokenId = padTokenId
+        self.attnImplementation = attnImplementation
+        self.dtype = dtype
+    
+    def __call__(self, features):
+        maxLength = max(len(feature["input_ids"]) for feature in features)
+        inputIds = torch.full((len(features), maxLength), self.padTokenId, dtype = torch.long)
+        positionIds = torch.zeros((len(features), maxLength), dtype = torch.long)
+        for row, feature in enumerate(features):
+            length = len(feature["input_ids"])
+            inputIds[row, :length] = torch.tensor(feature["input_ids"], dtype = torch.long)
+            positionIds[row, :length] = torch.tensor(feature["position_ids"], dtype = torch.long)
+            # padding forms a separate sequence of its own
+            positionIds[row, length:] = torch.arange(maxLength - length)
+        
+        # The first token of an example must not be predicted from the previous example
+        exampleStarts = positionIds == 0
+        labels = inputIds.clone()
+        labels[exampleStarts] = -100
+        for row, feature in enumerate(features):
+            labels[row, len(feature["input_ids"]):] = -100
+        
+        batch = {"input_ids": inputIds, "labels": labels, "position_ids": positionIds}
+        
+        # Flash attention derives the sequence boundaries from the position ids, other implementations
+        # get a block diagonal causal mask
+        if self.attnImplementation != "flash_attention_2":
+            sequences = torch.cumsum(exampleStarts, dim = 1)
+            sameSequence = sequences.unsqueeze(2) == sequences.unsqueeze(1)
+            causal = torch.tril(torch.ones((maxLength, maxLength), dtype = torch.bool))
+            allowed = (sameSequence & causal).unsqueeze(1)
+            batch["attention_mask"] = torch.zeros(allowed.shape, dtype = self.dtype).masked_fill(~allowed, torch.finfo(self.dtype).min)
+        
+        return batch
+
+class TokenBudgetSampler(torch.utils.data.Sampler):
+    def __init__(self, dataset, tokenBudget: int, seed: int = 4711, processes: int = 1):
+        self.lengths = pyarrow.compute.list_value_length(dataset.with_format("arrow")["input_ids"]).to_numpy()
+        self.tokenBudget = tokenBudget
+        self.seed = seed
+        self.processes = processes
+        self.epoch = 0
+        self.sizes = self.__batchSizes(numpy.sort(self.lengths))
+    
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+    
+    def __len__(self):
+        # Batches are dealt to the processes in turn, every process gets the same number of batches
+        return len(self.sizes) - len(self.sizes) % self.processes
+    
+    def __iter__(self):
+        # Examples are sorted by length with random tie breaks, so batches hold examples of similar length and their
+        # number is the same in every epoch. The order of the batches is shuffled
+        generator = numpy.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        order = numpy.lexsort((generator.random(len(self.lengths)), self.lengths))
+        batches = numpy.split(order, numpy.cumsum(self.sizes)[:-1])
+        for batchNo in generator.permutation(len(batches))[:len(self)]:
+            yield batches[batchNo].tolist()
+    
+    def __batchSizes(self, sortedLengths):
+        # Padded batch tokens (examples * longest example) stay within the budget, longer examples form a batch of their own
+        sizes = []
+        size = 0
+        for length in sortedLengths:
+            if size > 0 and (size + 1) * length > self.tokenBudget:
+                sizes.append(size)
+                size = 0
+            size += 1
+        if size > 0:
+            sizes.append(size)
+        return sizes
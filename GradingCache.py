@@ -0,0 +1,67 @@
+import hashlib
+import os
+import pathlib
+import sqlite3
+import time
+
+class GradingCache:
+    hits = 0
+    misses = 0
+    
+    def __init__(self, location: str, graderModel: str, graderPrompt: str, maxEntries: int):
+        self.maxEntries = maxEntries
+        self.identity = self.__identity(graderModel) + hashlib.sha256(graderPrompt.encode("utf-8")).hexdigest()
+        
+        os.makedirs(os.path.dirname(location) or ".", exist_ok = True)
+        self.connection = sqlite3.connect(location, check_same_thread = False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS gradings (key TEXT PRIMARY KEY, passed INTEGER NOT NULL, log TEXT, lastUsed REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS gradingsLastUsed ON gradings (lastUsed)")
+        self.connection.commit()
+    
+    def get(self, answer: str, gradingQuestion: str):
+        key = self.__key(answer, gradingQuestion)
+        row = self.connection.execute("SELECT passed, log FROM gradings WHERE key = ?", (key,)).fetchone()
+        if row == None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        self.connection.execute("UPDATE gradings SET lastUsed = ? WHERE key = ?", (time.time(), key))
+        return bool(row[0]), row[1]
+    
+    def put(self, answer: str, gradingQuestion: str, verdict):
+        passed, log = verdict
+        self.connection.execute("INSERT OR REPLACE INTO gradings (key, passed, log, lastUsed) VALUES (?, ?, ?, ?)",
+                                (self.__key(answer, gradingQuestion), int(passed), log, time.time()))
+    
+    def commit(self):
+        # Least recently used verdicts are evicted once the cache outgrows maxEntries
+        count = self.connection.execute("SELECT COUNT(*) FROM gradings").fetchone()[0]
+        if count > self.maxEntries:
+            self.connection.execute("DELETE FROM gradings WHERE key IN (SELECT key FROM gradings ORDER BY lastUsed ASC LIMIT ?)", (count - self.maxEntries,))
+        self.connection.commit()
+    
+    def resetStatistics(self):
+        self.hits = 0
+        self.misses = 0
+    
+    def close(self):
+        self.commit()
+        self.connection.close()
+    
+    def __key(self, answer: str, gradingQuestion: str):
+        normalised = " ".join(answer.split())
+        return hashlib.sha256("\0".join((self.identity, normalised, gradingQuestion)).encode("utf-8")).hexdigest()
+    
+    def __identity(self, graderModel: str):
+        # Local checkpoints are identified by their weights' names, sizes and modification times,
+        # so replacing the grader in place invalidates all its verdicts
+        identity = hashlib.sha256(graderModel.encode("utf-8"))
+        directory = pathlib.Path(graderModel)
+        if directory.is_dir():
+            identity = hashlib.sha256(str(directory.resolve()).encode("utf-8"))
+            for file in sorted(directory.iterdir()):
+                if file.is_file() and (file.suffix in (".safetensors", ".bin", ".json")):
+                    stat = file.stat()
+                    identity.update(f"{file.name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+        return identity.hexdigest()
@@ -16,22 +16,35 @@ def main():
     context.load(sys.argv[1])
     
     purgeTargetDirectories(context)
+    context.barrier()
 
+    try:
+        if not run(context):
+            sys.exit(0)
+    finally:
+        if context.mainProcess:
+            context.profiler.report(context.locWorkdir)
+    
+    print("Done")
+
+def run(context: Context):
     trainer = Trainer()
     trainer.train(context)
     
+    if not context.mainProcess:
+        return True
+    
     validator = Validator();
     if not validator.validate(context) and context.vAbortOnFail:
         print("Validation not passed, aborting")
-        sys.exit(0)
+        return False
     
     merger = Merger()
     merger.mergeAndStore(context)
-    
-    print("Done")
+    return True
 
 def purgeTargetDirectories(context: Context):
-    if not context.purgeTargetDirectories:
+    if not context.purgeTargetDirectories or not context.mainProcess:
         return
     
     print("Purging target directories")
@@ -1,36 +1,154 @@
+import json
+import math
+import os
+import re
+import shutil
+import pathlib
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
 from Context import Context
 from ModelLoader import ModelLoader
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
 from transformers import AutoTokenizer
-from peft import PeftModel
+
+DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}
 
 class Merger:
     def mergeAndStore(self, context: Context):
         if not context.mergeFull:
             return
         
+        if context.mergeStreaming:
+            if not context.storeAdapter:
+                raise Exception("Configuration problem: mergeFull requires storeAdapter")
+            with context.profiler.stage("streaming merge"):
+                self.__mergeStreaming(context)
+            return
+        
         if not context.model: 
             if not context.storeAdapter:
                 raise Exception("Configuration problem: mergeFull requires storeAdapter")
             
             print("Loading model")
-            baseModel = ModelLoader().load(context.locBaseModel, False, True, context)
-            context.model = PeftModel.from_pretrained(baseModel, context.locAdapter)
+            context.model = ModelLoader().loadPeft(context.locBaseModel, context.locAdapter, False, True, context)
+        
+        with context.profiler.stage("merge"):
+            print("Merging")
+            mergedModel = context.model.merge_and_unload()
+            # Merging modifies the model in place, it must not be handed out anymore
+            ModelLoader().evict(context.model, context)
+            context.model = None
+            
+            print("Dequantize")
+            try:
+                mergedModel = mergedModel.dequantize()
+            except:
+                pass
+        
+        with context.profiler.stage("save merged model"):
+            print("Storing model")
+            mergedModel.save_pretrained(save_directory = context.locFull)
+            
+            print("Storing tokenizer")
+            tokenizer = AutoTokenizer.from_pretrained(
+                    context.locBaseModel,
+                    trust_remote_code = True)
+            tokenizer.save_pretrained(context.locFull)
+        
+    
+    def __mergeStreaming(self, context: Context):
+        # The base checkpoint is merged shard by shard, only the shards being processed are held in memory
+        with open(os.path.join(context.locAdapter, "adapter_config.json"), 'r') as file:
+            adapterConfig = json.load(file)
+        if adapterConfig.get("use_dora") or adapterConfig.get("modules_to_save"):
+            raise Exception("Configuration problem: mergeStreaming does not support DoRA adapters or modules_to_save")
+        
+        adapter = load_file(os.path.join(context.locAdapter, "adapter_model.safetensors"))
+        deltas = {}
+        for key in adapter:
+            if "lora_embedding_" in key:
+                raise Exception("Configuration problem: mergeStreaming does not support adapters of embedding layers")
+            if not key.endswith(".lora_A.weight"):
+                continue
+            module = key[:-len(".lora_A.weight")]
+            baseModule = module[len("base_model.model."):] if module.startswith("base_model.model.") else module
+            deltas[baseModule + ".weight"] = (adapter[key], adapter[module + ".lora_B.weight"], self.__scaling(baseModule, adapterConfig))
+        
+        base = pathlib.Path(context.locBaseModel)
+        indexFile = base / "model.safetensors.index.json"
+        if indexFile.exists():
+            with open(indexFile, 'r') as file:
+                index = json.load(file)
+            shards = sorted(set(index["weight_map"].values()))
+        elif (base / "model.safetensors").exists():
+            index = None
+            shards = ["model.safetensors"]
+        else:
+            raise Exception("Configuration problem: mergeStreaming requires a safetensors base model")
+        
+        dataType = DTYPES[context.mergeDtype] if context.mergeDtype else None
+        
+        os.makedirs(context.locFull, exist_ok = True)
+        for file in base.iterdir():
+            if file.is_file() and file.suffix not in (".safetensors", ".bin") and file.name != indexFile.name:
+                shutil.copy2(file, os.path.join(context.locFull, file.name))
+        
+        def mergeShard(shard):
+            tensors = {}
+            merged = []
+            with safe_open(str(base / shard), framework = "pt") as f:
+                for name in f.keys():
+                    tensor = f.get_tensor(name)
+                    if name in deltas:
+                        loraA, loraB, scaling = deltas[name]
+                        delta = (loraB.float() @ loraA.float()) * scaling
+                        if adapterConfig.get("fan_in_fan_out"):
+                            delta = delta.T
+                        tensor = (tensor.float() + delta).to(tensor.dtype)
+                        merged.append(name)
+                    if dataType != None and tensor.is_floating_point():
+                        tensor = tensor.to(dataType)
+                    tensors[name] = tensor
+            save_file(tensors, os.path.join(context.locFull, shard), metadata = {"format": "pt"})
+            print(f"Merged {shard}: {len(merged)} adapted tensors")
+            return merged, sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+        
+        print(f"Merging {len(shards)} shards with {context.mergeWorkers} workers")
+        with ThreadPoolExecutor(max_workers = context.mergeWorkers) as executor:
+            results = list(executor.map(mergeShard, shards))
         
-        print("Merging")
-        mergedModel = context.model.merge_and_unload()
+        missing = set(deltas.keys()) - set(name for merged, _ in results for name in merged)
+        if len(missing) > 0:
+            raise Exception(f"Adapter tensors without base model weight: {sorted(missing)}")
         
-        print("Dequantize")
-        try:
-            mergedModel = mergedModel.dequantize()
-        except:
-            pass
+        if index != None:
+            index["metadata"] = dict(index.get("metadata") or {}, total_size = sum(size for _, size in results))
+            with open(os.path.join(context.locFull, indexFile.name), 'w') as file:
+                json.dump(index, file, indent = 2)
         
-        print("Storing model")
-        mergedModel.save_pretrained(save_directory = context.locFull)
+        if dataType != None:
+            configFile = os.path.join(context.locFull, "config.json")
+            with open(configFile, 'r') as file:
+                config = json.load(file)
+            config["torch_dtype"] = str(dataType).replace("torch.", "")
+            with open(configFile, 'w') as file:
+                json.dump(config, file, indent = 2)
         
         print("Storing tokenizer")
         tokenizer = AutoTokenizer.from_pretrained(
                 context.locBaseModel,
                 trust_remote_code = True)
         tokenizer.save_pretrained(context.locFull)
-        
\ No newline at end of file
+    
+    def __scaling(self, module: str, adapterConfig):
+        # Rank and alpha patterns are matched like peft does, by module name suffix
+        def pattern(patterns, default):
+            key = next(filter(lambda key: re.match(rf".*\.{key}$", module), patterns.keys()), None)
+            return patterns[key] if key != None else default
+        r = pattern(adapterConfig.get("rank_pattern") or {}, adapterConfig["r"])
+        alpha = pattern(adapterConfig.get("alpha_pattern") or {}, adapterConfig["lora_alpha"])
+        if adapterConfig.get("use_rslora"):
+            return alpha / math.sqrt(r)
+        return alpha / r
@@ -1,14 +1,107 @@
+import gc
+import os
+import pathlib
+import time
 import torch
 
+from collections import OrderedDict
 from Context import Context
+from peft import PeftModel
 from transformers import (
     AutoModelForCausalLM,
     BitsAndBytesConfig
 )
 
 class ModelLoader:
-    def load(self, path: str, forceCpu: bool, q4OnGpu: bool, context: Context):
-        q4 = context.qLora and q4OnGpu and context.accel and not forceCpu
+    # Resident models shared by all pipeline stages, least recently used first.
+    # Key: (path, adapter path, dtype, 4bit quantization, int8 quantization, device)
+    models = OrderedDict()
+    
+    def load(self, path: str, forceCpu: bool, q4OnGpu: bool, context: Context, int8OnCpu: bool = False):
+        key = self.__key(path, None, forceCpu, q4OnGpu, int8OnCpu, context)
+        if key in self.models:
+            print(f"Reusing resident model {path}")
+            self.models.move_to_end(key)
+            return self.models[key]
+        
+        baseModel = self.__load(path, forceCpu, q4OnGpu, int8OnCpu, context)
+        if self.__int8(int8OnCpu, forceCpu, context):
+            baseModel = self.__quantizeInt8(baseModel, path, context)
+        self.models[key] = baseModel
+        return baseModel
+    
+    def loadPeft(self, path: str, adapterPath: str, forceCpu: bool, q4OnGpu: bool, context: Context, int8OnCpu: bool = False):
+        key = self.__key(path, adapterPath, forceCpu, q4OnGpu, int8OnCpu, context)
+        if key in self.models:
+            print(f"Reusing resident model {path} with adapter {adapterPath}")
+            self.models.move_to_end(key)
+            return self.models[key]
+        
+        if self.__int8(int8OnCpu, forceCpu, context):
+            # Lora layers cannot wrap quantized linear layers, the adapter is merged into a float32 copy of the base model first.
+            # The result is for inference only
+            baseModel = self.__load(path, forceCpu, q4OnGpu, int8OnCpu, context)
+            peftModel = PeftModel.from_pretrained(baseModel, adapterPath).merge_and_unload()
+            peftModel = self.__quantizeInt8(peftModel, path, context)
+        else:
+            # Attaching the adapter modifies the base model, it is not handed out as plain base model anymore
+            baseModel = self.take(path, forceCpu, q4OnGpu, context)
+            peftModel = PeftModel.from_pretrained(baseModel, adapterPath)
+        self.models[key] = peftModel
+        return peftModel
+    
+    def take(self, path: str, forceCpu: bool, q4OnGpu: bool, context: Context):
+        # For callers that modify the model, e.g. by attaching an adapter
+        baseModel = self.load(path, forceCpu, q4OnGpu, context)
+        del self.models[self.__key(path, None, forceCpu, q4OnGpu, False, context)]
+        return baseModel
+    
+    def register(self, model, path: str, adapterPath: str, forceCpu: bool, q4OnGpu: bool, context: Context):
+        # Models of a previous adapter at the same location, e.g. merged int8 copies, are outdated
+        key = self.__key(path, adapterPath, forceCpu, q4OnGpu, False, context)
+        for outdated in [resident for resident in self.models if resident[:2] == key[:2]]:
+            del self.models[outdated]
+        self.models[key] = model
+    
+    def unloadAdapter(self, adapterPath: str, context: Context):
+        # Models with the adapter attached are detached and stay resident as base models, merged copies are dropped
+        for key in [key for key in self.models if key[1] == os.path.abspath(adapterPath)]:
+            model = self.models.pop(key)
+            if isinstance(model, PeftModel):
+                baseModel = model.unload()
+                if baseModel.is_gradient_checkpointing:
+                    baseModel.gradient_checkpointing_disable()
+                self.models[(key[0], None) + key[2:]] = baseModel
+        self.__collect(context)
+    
+    def evict(self, model, context: Context):
+        for key in [key for key, resident in self.models.items() if resident is model]:
+            del self.models[key]
+        self.__collect(context)
+    
+    def __key(self, path: str, adapterPath: str, forceCpu: bool, q4OnGpu: bool, int8OnCpu: bool, context: Context):
+        int8 = self.__int8(int8OnCpu, forceCpu, context)
+        return (os.path.abspath(path),
+                os.path.abspath(adapterPath) if adapterPath else None,
+                self.__dataType(forceCpu, int8, context),
+                self.__q4(q4OnGpu, forceCpu, context),
+                int8,
+                "cpu" if forceCpu else context.device)
+    
+    def __q4(self, q4OnGpu: bool, forceCpu: bool, context: Context):
+        return context.qLora and q4OnGpu and context.accel and not forceCpu
+    
+    def __int8(self, int8OnCpu: bool, forceCpu: bool, context: Context):
+        return context.vCpuInt8 and int8OnCpu and (forceCpu or not context.accel)
+    
+    def __dataType(self, forceCpu: bool, int8: bool, context: Context):
+        # Dynamic int8 quantization requires float32 linear layers
+        if int8:
+            return torch.float32
+        return torch.float16 if context.accel and not forceCpu else torch.bfloat16
+    
+    def __load(self, path: str, forceCpu: bool, q4OnGpu: bool, int8OnCpu: bool, context: Context):
+        q4 = self.__q4(q4OnGpu, forceCpu, context)
         
         bbConfig = BitsAndBytesConfig(
            load_in_4bit=True,
@@ -16,18 +109,101 @@ class ModelLoader:
            bnb_4bit_use_double_quant=True, # reduce precision loss
            bnb_4bit_compute_dtype=torch.float16
         )
-        torchDataType = torch.float16 if context.accel and not forceCpu else torch.bfloat16
+        torchDataType = self.__dataType(forceCpu, self.__int8(int8OnCpu, forceCpu, context), context)
+        
+        self.__ensureMemory(path, forceCpu, q4, torchDataType, context)
         
-        print(f"Loading model {path} (gpu={context.accel and not forceCpu}, q4={q4}, dt={torchDataType})...")
+        print(f"Loading model {path} (gpu={context.accel and not forceCpu}, q4={q4}, dt={torchDataType}, fast={context.fastModelLoad})...")
         
-        baseModel = AutoModelForCausalLM.from_pretrained(
-                path,
-                quantization_config=bbConfig if q4 else None,
-                torch_dtype=torchDataType,
-                trust_remote_code=True)
-        if not forceCpu:
-            baseModel = baseModel.to(context.device)
+        loadArgs = {}
+        if context.fastModelLoad:
+            # Parameters are created on the meta device and the memory mapped safetensors shards are streamed
+            # straight to the target device, without materialising the model in host memory first
+            loadArgs["low_cpu_mem_usage"] = True
+            loadArgs["device_map"] = {"": "cpu" if forceCpu else context.device}
         
-        print(baseModel)
+        startTime = time.perf_counter()
+        startRead = self.__bytesRead()
+        with context.profiler.stage(f"model load {path}"):
+            baseModel = AutoModelForCausalLM.from_pretrained(
+                    path,
+                    quantization_config=bbConfig if q4 else None,
+                    torch_dtype=torchDataType,
+                    trust_remote_code=True,
+                    **loadArgs)
+            if not forceCpu and not context.fastModelLoad:
+                baseModel = baseModel.to(context.device)
+        
+        seconds = time.perf_counter() - startTime
+        checkpointSize = self.__checkpointSize(path)
+        print(f"Loaded model {path} in {seconds:.1f}s, checkpoint {checkpointSize / 2**20:.0f} MiB, read from storage {(self.__bytesRead() - startRead) / 2**20:.0f} MiB ({checkpointSize / 2**20 / max(seconds, 1e-6):.0f} MiB/s)")
+        
+        if context.showModel:
+            print(baseModel)
         
         return baseModel
+    
+    def __quantizeInt8(self, model, path: str, context: Context):
+        before = self.__benchmark(model, context) if context.vCpuBenchmark else None
+        
+        with context.profiler.stage(f"int8 quantization {path}"):
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype = torch.qint8)
+        if context.vCompile:
+            model.forward = torch.compile(model.forward, dynamic = True)
+        
+        if before != None:
+            if context.vCompile:
+                # Warm up, the first calls compile the forward pass
+                self.__benchmark(model, context)
+            print(f"Cpu inference {path}: float32 {before:.1f} tokens/s, int8{' compiled' if context.vCompile else ''} {self.__benchmark(model, context):.1f} tokens/s")
+        return model
+    
+    def __benchmark(self, model, context: Context):
+        # Decodes a fixed number of tokens after a short random prompt
+        inputIds = torch.randint(0, model.config.vocab_size, (1, 32))
+        startTime = time.perf_counter()
+        with torch.no_grad():
+            model.generate(input_ids = inputIds, attention_mask = torch.ones_like(inputIds), max_new_tokens = 16, min_new_tokens = 16,
+                           do_sample = False, pad_token_id = 0)
+        return 16 / (time.perf_counter() - startTime)
+    
+    def __checkpointSize(self, path: str):
+        return sum(f.stat().st_size for f in pathlib.Path(path).glob("*") if f.suffix in (".safetensors", ".bin"))
+    
+    def __bytesRead(self):
+        # Bytes this process fetched from storage, page cache hits of the memory mapped shards are not counted
+        try:
+            with open("/proc/self/io", 'r') as file:
+                for line in file:
+                    if line.startswith("read_bytes:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+    
+    def __ensureMemory(self, path: str, forceCpu: bool, q4: bool, torchDataType, context: Context):
+        # Resident models are only evicted when the new model would not fit next to them
+        required = self.__checkpointSize(path)
+        if q4:
+            required //= 3
+        if torchDataType == torch.float32:
+            required *= 2
+        onAccel = context.accel and not forceCpu
+        device = "cpu" if forceCpu else context.device
+        while context.availableMemory(onAccel) < required * 1.2:
+            # Only models on the device that is short of memory are evicted
+            candidates = [key for key in self.models if key[5] == device]
+            if len(candidates) == 0:
+                break
+            available = context.availableMemory(onAccel)
+            del self.models[candidates[0]]
+            print(f"Evicting resident model {candidates[0][0]}" + (f" with adapter {candidates[0][1]}" if candidates[0][1] else ""))
+            self.__collect(context)
+            # The model is still in use elsewhere, e.g. as the trained model, evicting more would not help either
+            if context.availableMemory(onAccel) <= available:
+                break
+    
+    def __collect(self, context: Context):
+        gc.collect()
+        if context.accel:
+            torch.cuda.empty_cache()
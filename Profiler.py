@@ -0,0 +1,100 @@
+import json
+import os
+import resource
+import threading
+import time
+import torch
+
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+
+@dataclass
+class ProfileStage:
+    name: str
+    wallTime: float
+    peakRss: int
+    peakCudaMemory: int
+    tokens: int
+    throughput: float
+
+class Profiler:
+    def __init__(self, sampleInterval: float = 0.1):
+        self.stages = []
+        self.active = []
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+        self.sampleInterval = sampleInterval
+        self.sampling = False
+    
+    @contextmanager
+    def stage(self, name: str):
+        current = {"name": name, "start": time.perf_counter(), "peakRss": self.__rss(), "peakCudaMemory": 0, "tokens": 0, "thread": threading.get_ident()}
+        with self.lock:
+            self.__updateCudaPeaks()
+            self.active.append(current)
+            if not self.sampling:
+                self.sampling = True
+                threading.Thread(target = self.__sample, name = "profiler", daemon = True).start()
+        try:
+            yield current
+        finally:
+            with self.lock:
+                self.__updateCudaPeaks()
+                self.active.remove(current)
+            current["peakRss"] = max(current["peakRss"], self.__rss())
+            wallTime = time.perf_counter() - current["start"]
+            stage = ProfileStage(name, wallTime, current["peakRss"], current["peakCudaMemory"], current["tokens"], current["tokens"] / wallTime if wallTime > 0 else 0.0)
+            self.stages.append(stage)
+            print(f"[profile] {name}: {wallTime:.1f}s, peak rss {stage.peakRss / 2**20:.0f} MiB" +
+                  (f", peak cuda {stage.peakCudaMemory / 2**20:.0f} MiB" if torch.cuda.is_available() else "") +
+                  (f", {stage.tokens} tokens ({stage.throughput:.1f} tokens/s)" if stage.tokens else ""))
+    
+    def count(self, tokens: int):
+        # Tokens are accounted to the innermost running stage of the calling thread
+        with self.lock:
+            for current in reversed(self.active):
+                if current["thread"] == threading.get_ident():
+                    current["tokens"] += int(tokens)
+                    return
+    
+    def report(self, location: str):
+        os.makedirs(location, exist_ok = True)
+        path = os.path.join(location, time.strftime("profile-%Y%m%d-%H%M%S.json", time.localtime(self.startTime)))
+        with open(path, 'w') as file:
+            json.dump({
+                "started": self.startTime,
+                "wallTime": time.time() - self.startTime,
+                # ru_maxrss is reported in KiB on linux
+                "peakRss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "peakCudaMemory": max((stage.peakCudaMemory for stage in self.stages), default = 0),
+                "stages": [asdict(stage) for stage in self.stages]
+            }, file, indent = 2)
+        print(f"Profile written to {path}")
+        return path
+    
+    def __updateCudaPeaks(self):
+        # The cuda peak counter is global, so it is folded into every running stage before it is reset
+        if not torch.cuda.is_available():
+            return
+        peak = torch.cuda.max_memory_allocated()
+        for current in self.active:
+            current["peakCudaMemory"] = max(current["peakCudaMemory"], peak)
+        torch.cuda.reset_peak_memory_stats()
+    
+    def __sample(self):
+        while True:
+            with self.lock:
+                if len(self.active) == 0:
+                    self.sampling = False
+                    return
+                rss = self.__rss()
+                for current in self.active:
+                    current["peakRss"] = max(current["peakRss"], rss)
+            time.sleep(self.sampleInterval)
+    
+    def __rss(self):
+        try:
+            with open("/proc/self/statm", 'r') as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,30 @@
+import torch
+
+from transformers import StoppingCriteria
+
+class StopCriteria(StoppingCriteria):
+    def __init__(self, tokenizer, promptLength: int, stops: list, closeJson: bool):
+        # stops: stop strings of every row of the batch
+        self.tokenizer = tokenizer
+        self.promptLength = promptLength
+        self.stops = stops
+        self.closeJson = closeJson
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        # Rows are finished individually, generate pads finished rows until the whole batch is done
+        texts = self.tokenizer.batch_decode(input_ids[:, self.promptLength:])
+        done = [self.__stopped(text, stops) for text, stops in zip(texts, self.stops)]
+        return torch.tensor(done, dtype = torch.bool, device = input_ids.device)
+    
+    def __stopped(self, text: str, stops: list):
+        if any(stop in text for stop in stops):
+            return True
+        # The grader's answer is complete once its json object is closed
+        if self.closeJson and "{" in text:
+            depth = 0
+            for character in text[text.index("{"):]:
+                depth += 1 if character == "{" else -1 if character == "}" else 0
+                if depth == 0:
+                    return True
+        return False
+
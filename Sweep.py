@@ -0,0 +1,150 @@
+import configparser
+import itertools
+import multiprocessing
+import os
+import re
+import sys
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from Context import Context
+from Dataset import Dataset
+from Main import run
+from ModelLoader import ModelLoader
+from transformers import AutoTokenizer
+
+def main():
+    if not len(sys.argv) == 3:
+        print("Arguments missing: Configuration file, sweep file")
+        sys.exit(1)
+    
+    configFile = sys.argv[1]
+    processes, variants = loadVariants(sys.argv[2])
+    
+    base = configparser.ConfigParser()
+    if not base.read(configFile):
+        raise Exception("Cannot read configuration file: " + configFile)
+    sweepDirectory = os.path.join(base.get("Trainer", "locWorkdir"), "sweep")
+    datasetCache = base.get("Dataset", "locDatasetCache", fallback = "") or os.path.join(base.get("Trainer", "locWorkdir"), "dataset_cache")
+    
+    for name, overrides in variants:
+        # Every variant writes to its own locations, the tokenized dataset cache is shared
+        overrides.setdefault("locWorkdir", os.path.join(sweepDirectory, name))
+        overrides.setdefault("locAdapter", os.path.join(base.get("Trainer", "locAdapter"), name))
+        overrides.setdefault("locFull", os.path.join(base.get("Merger", "locFull"), name))
+        overrides.setdefault("locDatasetCache", datasetCache)
+        overrides["purgeTargetDirectories"] = "false"
+        # Merging detaches the adapter from the resident base model by modifying it, variants are usually compared unmerged
+        overrides.setdefault("mergeFull", "false")
+        if processes > 1:
+            # Concurrent variants share the cpu cores
+            overrides["device"] = "cpu"
+            overrides.setdefault("cpuThreads", str(max(1, os.cpu_count() // processes)))
+        for path in (overrides["locWorkdir"], overrides["locAdapter"], overrides["locFull"]):
+            os.makedirs(path, exist_ok = True)
+    
+    print(f"Sweeping {len(variants)} variants" + (f", {processes} at a time" if processes > 1 else ""))
+    if processes > 1:
+        prepareDatasets(configFile, variants)
+        with ProcessPoolExecutor(max_workers = processes, mp_context = multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(runVariant, [configFile] * len(variants), [name for name, _ in variants], [overrides for _, overrides in variants]))
+    else:
+        # The tokenized dataset and the base model stay resident in this process for all variants
+        results = [runVariant(configFile, name, overrides) for name, overrides in variants]
+    
+    writeSummary(sweepDirectory, [name for name, _ in variants], results)
+    print("Done")
+
+def loadVariants(sweepFile: str):
+    cfg = configparser.ConfigParser()
+    cfg.optionxform = str
+    if not cfg.read(sweepFile):
+        raise Exception("Cannot read sweep file: " + sweepFile)
+    
+    processes = cfg.getint("Sweep", "processes", fallback = 1)
+    
+    # Named sections are variants on their own, every grid point is applied to each of them
+    named = [(section, dict(cfg.items(section))) for section in cfg.sections() if section not in ("Sweep", "Grid")]
+    if len(named) == 0:
+        named = [("", {})]
+    
+    grid = dict(cfg.items("Grid")) if cfg.has_section("Grid") else {}
+    keys = list(grid.keys())
+    points = list(itertools.product(*[[value.strip() for value in grid[key].split("|")] for key in keys]))
+    
+    variants = []
+    for section, overrides in named:
+        for point in points:
+            variantOverrides = dict(overrides)
+            variantOverrides.update(zip(keys, point))
+            name = "-".join([section] * (section != "") + [f"{key}{value}" for key, value in zip(keys, point)]) or "base"
+            variants.append((re.sub(r"[^A-Za-z0-9_.=-]", "_", name), variantOverrides))
+    return processes, variants
+
+def prepareDatasets(configFile: str, variants: list):
+    # The tokenized dataset cache is filled once before the variant processes start, so they only read from it
+    for name, overrides in variants:
+        try:
+            context = Context()
+            context.load(configFile, overrides)
+            if not context.train or not context.dsCache or context.dsStreaming:
+                continue
+            tokenizer = AutoTokenizer.from_pretrained(context.locBaseModel, trust_remote_code = True)
+            if tokenizer.pad_token == None:
+                tokenizer.pad_token = tokenizer.eos_token
+            Dataset().scan(context.locDataset, tokenizer, context)
+        except Exception:
+            # The variant reports its error when it runs
+            traceback.print_exc()
+
+def runVariant(configFile: str, name: str, overrides: dict):
+    print(f"Sweep variant {name}: {overrides}")
+    context = Context()
+    try:
+        context.load(configFile, overrides)
+    except Exception:
+        traceback.print_exc()
+        return {"status": "failed", "tokensPerSecond": None, "trainLoss": None, "passRate": None}
+    
+    status = "ok"
+    try:
+        if not run(context):
+            status = "validation failed"
+    except Exception:
+        traceback.print_exc()
+        status = "failed"
+    finally:
+        context.profiler.report(context.locWorkdir)
+        # The adapter is detached, the base model stays resident for the next variant
+        context.model = None
+        ModelLoader().unloadAdapter(context.locAdapter, context)
+    
+    trainingRuns = [stage for stage in context.profiler.stages if stage.name.startswith("training run")]
+    trainingTime = sum(stage.wallTime for stage in trainingRuns)
+    return {
+        "status": status,
+        "tokensPerSecond": sum(stage.tokens for stage in trainingRuns) / trainingTime if trainingTime > 0 else None,
+        "trainLoss": context.results.get("trainLoss"),
+        "passRate": context.results.get("passRate")
+    }
+
+def writeSummary(location: str, names: list, results: list):
+    rows = [("variant", "status", "train tokens/s", "final loss", "pass rate %")]
+    for name, result in zip(names, results):
+        rows.append((name,
+                     result["status"],
+                     f"{result['tokensPerSecond']:.1f}" if result["tokensPerSecond"] != None else "-",
+                     f"{result['trainLoss']:.4f}" if result["trainLoss"] != None else "-",
+                     f"{result['passRate']}" if result["passRate"] != None else "-"))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    table = "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+    
+    os.makedirs(location, exist_ok = True)
+    path = os.path.join(location, "summary.txt")
+    with open(path, 'w') as file:
+        file.write(table + "\n")
+    print(table)
+    print(f"Sweep summary written to {path}")
+
+if __name__ == "__main__":
+    main()
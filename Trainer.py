@@ -1,43 +1,71 @@
 import gc
+import hashlib
+import json
+import math
+import numpy
+import os
+import re
+import shutil
 import torch
 
+from BudgetSFTTrainer import BudgetSFTTrainer
 from Context import Context
-from Dataset import Dataset
+from Dataset import Dataset, PackedDataCollator
 from ModelLoader import ModelLoader
 from transformers import AutoTokenizer
-from peft import LoraConfig
+from peft import LoraConfig, set_peft_model_state_dict
+from safetensors.torch import load_file
 from trl import SFTTrainer, SFTConfig
 from Validator import Validator
+from ValidationCallback import ValidationCallback
 
 class Trainer:
     def train(self, context: Context):
         if not context.train:
             return
         
-        baseModel = ModelLoader().load(context.locBaseModel, False, True, context)
+        baseModel = ModelLoader().take(context.locBaseModel, False, True, context)
         sftTrainer = self.__createTrainer(baseModel, context)
         context.model = sftTrainer.model
         
         vInplace = context.validate and context.vInplace
         validator = None
+        callback = None
         if vInplace:
             validator = Validator()
+            callback = ValidationCallback(validator, sftTrainer.tokenizer, context)
+            sftTrainer.add_callback(callback)
+            print(f"In-Place validation: at most {context.vMaxRuns} training runs" if context.vMaxRuns else "In-Place validation: training runs are not bounded")
         
         try:
             cnt = 0
+            if context.trSaveSteps:
+                cnt = self.__resume(sftTrainer, context)
             continueTraining = True
             while continueTraining:
                 cnt += 1
                 print(f"Training run {cnt}")
                 
-                self.__train(sftTrainer)
+                with context.profiler.stage(f"training run {cnt}"):
+                    self.__train(sftTrainer, cnt, context)
+                    context.profiler.count(sftTrainer.state.num_input_tokens_seen)
+                
+                if context.trSaveSteps:
+                    self.__completeRun(sftTrainer, cnt, False, context)
                 
                 if vInplace:
-                    continueTraining = not validator.validateInPlace(sftTrainer.tokenizer, sftTrainer.model, context)
+                    if not callback.validated(sftTrainer.state.global_step):
+                        callback.validate(sftTrainer.model, sftTrainer.state.global_step)
+                    continueTraining = not callback.exhausted(cnt)
                 else:
                     continueTraining = False
             
             print(f"Total training runs: {cnt} epochs {cnt * (context.trEpochs or 1)}")
+            if vInplace:
+                print(f"In-Place validation stopped: {callback.stopReason}")
+            
+            if context.trSaveSteps and context.mainProcess:
+                self.__saveLoopState(cnt, True, context)
             
         finally:
             if vInplace:
@@ -46,6 +74,8 @@ class Trainer:
         
         if context.storeAdapter:
             self.__storeAdapter(sftTrainer, context)
+            # Validation and merging reuse the trained model instead of loading base model and adapter again
+            ModelLoader().register(sftTrainer.model, context.locBaseModel, context.locAdapter, False, True, context)
         
     def __createTrainer(self, baseModel, context: Context):
         tokenizer = AutoTokenizer.from_pretrained(
@@ -54,8 +84,6 @@ class Trainer:
         if tokenizer.pad_token == None:
             tokenizer.pad_token = tokenizer.eos_token
         
-        dataset = Dataset().scan(context.locDataset, tokenizer, context)
-        
         peftConfig = LoraConfig(
                 r = context.loraR,
                 lora_alpha = context.loraAlpha,
@@ -80,40 +108,164 @@ class Trainer:
             sftArgs["auto_find_batch_size"] = context.trFindAutoBatchSize
         if context.trGradientAccSteps:
             sftArgs["gradient_accumulation_steps"] = context.trGradientAccSteps
+        if context.trTokenBudget and context.trTokensPerStep:
+            # Batches hold up to trTokenBudget tokens, the accumulation keeps the tokens per optimizer step constant
+            sftArgs["gradient_accumulation_steps"] = math.ceil(context.trTokensPerStep / (context.trTokenBudget * context.worldSize))
         if context.trGradientCheckpointing:
             sftArgs["gradient_checkpointing"] = context.trGradientCheckpointing
-        if context.trGroupByLength:
+        if context.trGroupByLength and not context.dsStreaming and not context.trTokenBudget:
             sftArgs["group_by_length"] = context.trGroupByLength
-        if context.trPacking:
+        if context.trPacking and not context.dsPacking:
             sftArgs["packing"] = context.trPacking
         if context.trOptim:
             sftArgs["optim"] = context.trOptim
         if context.trSchedulerType:
             sftArgs["lr_scheduler_type"] = context.trSchedulerType
+        if context.trMaxSteps:
+            sftArgs["max_steps"] = context.trMaxSteps
+        if context.trSaveSteps:
+            sftArgs["save_strategy"] = "steps"
+            sftArgs["save_steps"] = context.trSaveSteps
+            sftArgs["save_total_limit"] = context.trSaveTotalLimit
+        else:
+            sftArgs["save_strategy"] = "no"
+        if context.worldSize > 1:
+            sftArgs["ddp_backend"] = "nccl" if context.accel else "gloo"
+            sftArgs["ddp_find_unused_parameters"] = False
+            if context.trFsdp:
+                sftArgs["fsdp"] = context.trFsdp
         sftConfig = SFTConfig(
                 output_dir=context.locWorkdir,
-                save_strategy="no",
+                # Counting tokens fails when gathered from several processes in some transformers versions
+                include_num_input_tokens_seen=context.worldSize == 1,
                 #neftune_noise_alpha=5,
                 dataset_kwargs={'skip_prepare_dataset': True},
                 **sftArgs
         )
         
-        sftTrainer = SFTTrainer(
+        # The main process encodes the dataset into the cache first, the other processes load it from there
+        with sftConfig.main_process_first(local = False, desc = "dataset scan"):
+            dataset = Dataset().scan(context.locDataset, tokenizer, context)
+        
+        trainerArgs = {}
+        trainerClass = SFTTrainer
+        if context.trTokenBudget:
+            trainerClass = BudgetSFTTrainer
+            trainerArgs["tokenBudget"] = context.trTokenBudget
+        if context.dsPacking:
+            trainerArgs["data_collator"] = PackedDataCollator(
+                    tokenizer.pad_token_id,
+                    baseModel.config._attn_implementation,
+                    torch.float16 if context.accel else torch.bfloat16)
+        
+        sftTrainer = trainerClass(
                 model = baseModel,
                 train_dataset = dataset,
                 tokenizer = tokenizer,
                 peft_config = peftConfig,
-                args = sftConfig
+                args = sftConfig,
+                **trainerArgs
         )
         
         return sftTrainer
         
-    def __train(self, sftTrainer):
-        sftTrainer.train()
+    def __train(self, sftTrainer, cnt: int, context: Context):
+        resumeFrom = None
+        if context.trSaveSteps:
+            # Every training run of the in-place validation loop checkpoints into a directory of its own
+            sftTrainer.args.output_dir = self.__runDirectory(cnt, context)
+            if context.trResume:
+                resumeFrom = self.__latestCheckpoint(sftTrainer.args.output_dir)
+        
+        if resumeFrom != None:
+            print(f"Resuming from checkpoint {resumeFrom}")
+            # The rng state of our own checkpoints contains numpy arrays, which torch.load rejects by default.
+            # numpy 1.x has no numpy._core
+            numpyCore = numpy._core if hasattr(numpy, "_core") else numpy.core
+            with torch.serialization.safe_globals([numpyCore.multiarray._reconstruct, numpy.ndarray, numpy.dtype, type(numpy.dtype(numpy.uint32))]):
+                output = sftTrainer.train(resume_from_checkpoint = resumeFrom)
+        else:
+            output = sftTrainer.train()
+        context.results["trainLoss"] = output.training_loss
         print("Training finished")
+    
+    def __checkpointDirectory(self, context: Context):
+        return os.path.join(context.locWorkdir, "checkpoints")
+    
+    def __runDirectory(self, cnt: int, context: Context):
+        return os.path.join(self.__checkpointDirectory(context), f"run-{cnt}")
+    
+    def __latestCheckpoint(self, runDirectory: str):
+        # Checkpoints are valid once trainer state and adapter have been written, interrupted saves are skipped
+        if not os.path.isdir(runDirectory):
+            return None
+        checkpoints = []
+        for entry in os.listdir(runDirectory):
+            match = re.fullmatch(r"checkpoint-(\d+)", entry)
+            path = os.path.join(runDirectory, entry)
+            if match and os.path.isfile(os.path.join(path, "trainer_state.json")) and \
+                    any(os.path.isfile(os.path.join(path, f)) for f in ("adapter_model.safetensors", "adapter_model.bin")):
+                checkpoints.append((int(match.group(1)), path))
+        return max(checkpoints)[1] if len(checkpoints) > 0 else None
+    
+    def __fingerprint(self, context: Context):
+        # Checkpoints are only resumed by a run with the same model, dataset and training configuration
+        keys = [key for key in context.__dict__ if key.startswith("tr") or key.startswith("lora") or key.startswith("ds")]
+        keys = [key for key in keys if key not in ("trResume", "trSaveSteps", "trSaveTotalLimit")]
+        config = {key: context.__dict__[key] for key in sorted(keys) + ["locBaseModel", "locDataset", "qLora"]}
+        return hashlib.sha256(json.dumps(config, sort_keys = True, default = str).encode("utf-8")).hexdigest()
+    
+    def __saveLoopState(self, completedRuns: int, finished: bool, context: Context):
+        os.makedirs(self.__checkpointDirectory(context), exist_ok = True)
+        stateFile = os.path.join(self.__checkpointDirectory(context), "loop_state.json")
+        with open(stateFile + ".tmp", 'w') as file:
+            json.dump({"completedRuns": completedRuns, "finished": finished, "fingerprint": self.__fingerprint(context)}, file)
+        os.replace(stateFile + ".tmp", stateFile)
+    
+    def __completeRun(self, sftTrainer, cnt: int, finished: bool, context: Context):
+        # The adapter of a completed run is the starting point of the next run after a restart
+        self.__saveModel(sftTrainer, os.path.join(self.__runDirectory(cnt, context), "final"), context)
+        if context.mainProcess:
+            self.__saveLoopState(cnt, finished, context)
+            if cnt > 1:
+                shutil.rmtree(self.__runDirectory(cnt - 1, context), ignore_errors = True)
+        context.barrier()
+    
+    def __resume(self, sftTrainer, context: Context):
+        # The main process decides and prepares the checkpoint directory, all processes load the same adapter
+        completedRuns = context.broadcast(self.__resumeState(context) if context.mainProcess else None)
+        if completedRuns > 0:
+            final = os.path.join(self.__runDirectory(completedRuns, context), "final", "adapter_model.safetensors")
+            print(f"Resuming after training run {completedRuns}")
+            set_peft_model_state_dict(sftTrainer.model, load_file(final))
+        return completedRuns
+    
+    def __resumeState(self, context: Context):
+        stateFile = os.path.join(self.__checkpointDirectory(context), "loop_state.json")
+        state = None
+        if context.trResume and os.path.isfile(stateFile):
+            with open(stateFile, 'r') as file:
+                state = json.load(file)
+        
+        if state == None or state["finished"] or state["fingerprint"] != self.__fingerprint(context):
+            if os.path.isdir(self.__checkpointDirectory(context)):
+                print("Discarding checkpoints of a previous training")
+                shutil.rmtree(self.__checkpointDirectory(context))
+            self.__saveLoopState(0, False, context)
+            return 0
+        
+        return state["completedRuns"]
         
     def __storeAdapter(self, sftTrainer, context: Context):
         print("Saving adapter...")
         
-        sftTrainer.model.save_pretrained(context.locAdapter)
-        sftTrainer.tokenizer.save_pretrained(context.locAdapter)
+        self.__saveModel(sftTrainer, context.locAdapter, context)
+        if context.mainProcess:
+            sftTrainer.tokenizer.save_pretrained(context.locAdapter)
+    
+    def __saveModel(self, sftTrainer, location: str, context: Context):
+        if context.worldSize > 1:
+            # Called by all processes, the trainer gathers sharded weights and writes them on the main process
+            sftTrainer.save_model(location)
+        else:
+            sftTrainer.model.save_pretrained(location)
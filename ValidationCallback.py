@@ -0,0 +1,89 @@
+import time
+
+from Context import Context
+from transformers import TrainerCallback
+
+class ValidationCallback(TrainerCallback):
+    def __init__(self, validator, tokenizer, context: Context):
+        self.validator = validator
+        self.tokenizer = tokenizer
+        self.context = context
+        self.startTime = time.time()
+        self.best = None
+        self.stale = 0
+        self.validatedStep = None
+        self.stopReason = None
+    
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.validatedStep = None
+    
+    def on_step_end(self, args, state, control, model = None, **kwargs):
+        if self.context.vSteps and state.global_step % self.context.vSteps == 0:
+            self.validate(model, state.global_step)
+        elif self.context.vMaxMinutes != None and self.context.broadcast(self.__outOfTime()):
+            self.stopReason = "time budget exhausted"
+        
+        if self.stopReason != None:
+            control.should_training_stop = True
+        return control
+    
+    def validate(self, model, step: int):
+        # Only the main process validates, the other processes wait for its decision
+        if self.context.mainProcess:
+            passed = self.__validate(model, step)
+        else:
+            passed = None
+        passed, self.stopReason = self.context.broadcast((passed, self.stopReason))
+        self.validatedStep = step
+        return passed
+    
+    def __validate(self, model, step: int):
+        # Dropout is disabled while answering, the trainer expects the model in training mode afterwards
+        training = model.training
+        model.eval()
+        try:
+            score = None
+            passed = True
+            if self.context.vSubsetSize:
+                print(f"Validating a subset of {self.context.vSubsetSize} questions at step {step}")
+                passed = self.validator.validateInPlace(self.tokenizer, model, self.context, self.context.vSubsetSize)
+                score = self.validator.statistics[-1][1]
+            
+            # The full validation set only runs once the cheap subset has passed
+            if passed:
+                print(f"Validating all questions at step {step}")
+                passed = self.validator.validateInPlace(self.tokenizer, model, self.context)
+                score = score if score != None else self.validator.statistics[-1][1]
+        finally:
+            if training:
+                model.train()
+        
+        if passed:
+            self.stopReason = "validation passed"
+        elif self.__plateau(score):
+            self.stopReason = f"no improvement in {self.context.vPatience} validations"
+        elif self.__outOfTime():
+            self.stopReason = "time budget exhausted"
+        return passed
+    
+    def validated(self, step: int):
+        return self.validatedStep == step
+    
+    def exhausted(self, runs: int):
+        if self.stopReason == None and self.context.vMaxRuns and runs >= self.context.vMaxRuns:
+            self.stopReason = f"maximum of {self.context.vMaxRuns} training runs reached"
+        elif self.stopReason == None and self.context.broadcast(self.__outOfTime()):
+            self.stopReason = "time budget exhausted"
+        return self.stopReason != None
+    
+    def __plateau(self, score: int):
+        # Scores are compared on the subset when one is configured, it is validated every time
+        if self.best == None or score >= self.best + self.context.vMinDelta:
+            self.best = score
+            self.stale = 0
+            return False
+        self.stale += 1
+        return self.context.vPatience != None and self.stale >= self.context.vPatience
+    
+    def __outOfTime(self):
+        return self.context.vMaxMinutes != None and time.time() - self.startTime >= self.context.vMaxMinutes * 60
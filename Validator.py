@@ -1,11 +1,19 @@
 import torch
 import gc
 import json
+import os
+import queue
+import random
+import re
+import string
+import threading
 
 from Context import Context
 from ModelLoader import ModelLoader
 from Dataset import Dataset
-from transformers import AutoTokenizer
+from GradingCache import GradingCache
+from StopCriteria import StopCriteria
+from transformers import AutoTokenizer, DynamicCache, StoppingCriteriaList
 from peft import PeftModel
 from dataclasses import dataclass
 
@@ -16,9 +24,13 @@ class Validator:
     extPeftModel = None
     graderTokenizer = None
     graderModel = None
+    gradingCache = None
+    compiled = None
     statistics = []
     
     def validate(self, context: Context):
+        if context.validate and context.vAdapters:
+            return self.validateAdapters(context)
         if not context.validate or context.vInplace:
             return True
         if not context.storeAdapter:
@@ -27,19 +39,22 @@ class Validator:
         print("Validation")
         
         validations = None
+        verdicts = {}
         self.__loadPeftModel(context)
         try:
-            validations = self.__askPeftModel(context)
+            validations = self.__askPeftModel(context, None, verdicts)
         finally:
+            # Unloading closes the grading cache, statistics of answers graded while generating are kept with the validations
+            if validations != None:
+                self.__keepGradingStatistics(validations)
             self.unload(context)
         
-        self.__loadGraderModel(context)
         try:
-            return self.__grade(validations, context)
+            return self.__grade(validations, context, verdicts)
         finally:
             self.unload(context)
     
-    def validateInPlace(self, peftTokenizer, peftModel, context: Context):
+    def validateInPlace(self, peftTokenizer, peftModel, context: Context, subsetSize: int = None):
         if not context.validate or not context.vInplace:
             return True
         
@@ -47,150 +62,334 @@ class Validator:
         
         self.extPeftTokenizer = peftTokenizer
         self.extPeftModel = peftModel
-        validations = self.__askPeftModel(context)
+        verdicts = {}
+        validations = self.__askPeftModel(context, subsetSize, verdicts)
         
-        if self.graderModel == None:
-            self.__loadGraderModel(context)
-        return self.__grade(validations, context)
+        return self.__grade(validations, context, verdicts)
+    
+    def validateAdapters(self, context: Context):
+        adapters = self.__findAdapters(context)
+        if len(adapters) == 0:
+            raise Exception("Configuration problem: vAdapters does not contain any adapter")
+        
+        print(f"Validating {len(adapters)} adapters")
+        
+        # The base model is loaded once, all adapters are attached to it and activated one after another
+        self.peftTokenizer = AutoTokenizer.from_pretrained(context.locBaseModel, trust_remote_code = True)
+        if self.peftTokenizer.pad_token == None:
+            self.peftTokenizer.pad_token = self.peftTokenizer.eos_token
+        baseModel = ModelLoader().take(context.locBaseModel, False, context.vQuantModel, context)
+        
+        answers = []
+        previous = None
+        try:
+            for i, adapter in enumerate(adapters):
+                name = f"adapter{i}"
+                if self.peftModel == None:
+                    self.peftModel = PeftModel.from_pretrained(baseModel, adapter, adapter_name = name)
+                else:
+                    self.peftModel.load_adapter(adapter, adapter_name = name)
+                self.peftModel.set_adapter(name)
+                # Only the active adapter is kept in memory, the previous one is swapped out
+                if previous != None:
+                    self.peftModel.delete_adapter(previous)
+                previous = name
+                self.peftModel.eval()
+                
+                print(f"Adapter {adapter}")
+                validations = self.__askPeftModel(context)
+                generation = next(stage for stage in reversed(context.profiler.stages) if stage.name == "generation")
+                answers.append((adapter, validations, generation.throughput))
+        finally:
+            # The base model is handed back without adapters, so a later merge or validation reuses it
+            if self.peftModel != None:
+                ModelLoader().register(self.peftModel.unload(), context.locBaseModel, None, False, context.vQuantModel, context)
+            del baseModel
+            self.unload(context)
+        
+        results = []
+        try:
+            for adapter, validations, throughput in answers:
+                print(f"Grading adapter {adapter}")
+                self.__grade(validations, context)
+                results.append((adapter, *self.statistics[-1], throughput))
+        finally:
+            self.unload(context)
+        
+        print("")
+        print("#############")
+        print(f"{'Adapter':<60} {'Pass rate':>10} {'Result':>8} {'Tokens/s':>10}")
+        for adapter, result, passedPerc, throughput in results:
+            print(f"{adapter:<60} {str(passedPerc) + '%':>10} {'PASSED' if result else 'FAILED':>8} {throughput:>10.1f}")
+        
+        # Passed when at least one of the adapters has passed
+        return any(result for _, result, _, _ in results)
+    
+    def __findAdapters(self, context: Context):
+        # Entries are adapter directories or directories containing adapters, e.g. the checkpoints of a training run
+        adapters = []
+        for location in context.vAdapters:
+            if os.path.isfile(os.path.join(location, "adapter_config.json")):
+                adapters.append(location)
+            elif os.path.isdir(location):
+                adapters.extend(sorted((os.path.join(location, entry) for entry in os.listdir(location)
+                                        if os.path.isfile(os.path.join(location, entry, "adapter_config.json"))),
+                                       key = self.__adapterOrder))
+        return adapters
+    
+    def __adapterOrder(self, location: str):
+        # Checkpoints are ordered by their step number, checkpoint-20 before checkpoint-100
+        name = os.path.basename(location)
+        match = re.search(r"^(.*?)(\d+)$", name)
+        return (match.group(1), int(match.group(2)), name) if match else (name, -1, name)
     
     def __loadPeftModel(self, context: Context):
         self.peftTokenizer = AutoTokenizer.from_pretrained(context.locBaseModel, trust_remote_code = True)
         if self.peftTokenizer.pad_token == None:
             self.peftTokenizer.pad_token = self.peftTokenizer.eos_token
         
-        baseModel = ModelLoader().load(context.locBaseModel, False, context.vQuantModel, context)
-        self.peftModel = PeftModel.from_pretrained(baseModel, context.locAdapter)
+        self.peftModel = ModelLoader().loadPeft(context.locBaseModel, context.locAdapter, False, context.vQuantModel, context, context.vQuantModel)
+        self.peftModel.eval()
     
-    def __askPeftModel(self, context: Context):
+    def __askPeftModel(self, context: Context, subsetSize: int = None, verdicts: dict = None):
         tokenizer = self.extPeftTokenizer or self.peftTokenizer
         model = self.extPeftModel or self.peftModel
         
+        compiled = self.__compile(tokenizer, context)
+        if subsetSize and subsetSize < len(compiled):
+            # The same subset is drawn every time, so its results stay comparable between validations
+            compiled = [compiled[i] for i in sorted(random.Random(4711).sample(range(len(compiled)), subsetSize))]
+        
+        print("Asking " + str(len(compiled) * context.vPasses) + " questions...")
+        
         result = Validations([], 0)
+        self.__resetGradingStatistics()
+        encoded = []
+        stops = []
+        jobs = []
+        for entry in compiled:
+            validation = Validation(entry.userPrompt, entry.userPromptType, [], entry.evalOneOfs, entry.evalStrings,
+                                    entry.evalRegexes, entry.evalExacts, entry.evalSimilars)
+            result.validations.append(validation)
+            if not entry.userPrompt:
+                continue
+            
+            for _ in range(0, context.vPasses):
+                encoded.append(entry.inputIds)
+                stops.append(context.vStops[entry.userPromptType])
+                jobs.append((validation, entry))
+            result.total += context.vPasses * (len(validation.evalOneOfs) + len(validation.evalStrings) + len(validation.evalRegexes) +
+                                               len(validation.evalExacts) + len(validation.evalSimilars))
         
-        dataset = Dataset().loadDataDir("json", context.locValidation, context)
+        genArgs = {}
+        if context.vDoSample:
+            genArgs["do_sample"] = True
+        # With the grader on cpu, answers are graded by a worker thread while the accelerator keeps generating
+        pairs = None
+        worker = None
+        if verdicts != None and context.vOverlapGrading and context.vGraderOnCpu and context.accel:
+            pairs = queue.Queue(maxsize = context.vGradingQueueSize)
+            errors = []
+            worker = threading.Thread(target = self.__gradeWorker, args = (pairs, verdicts, errors, context), name = "grader", daemon = True)
+            worker.start()
+        
+        def onBatch(batch, outputs):
+            for i, output in zip(batch, outputs):
+                validation, entry = jobs[i]
+                output = self.__truncate(output, context.vStops[entry.userPromptType])
+                # Completions are graded together with the text they continue
+                if not entry.trimPrompt:
+                    output = entry.prompt + output
+                
+                validation.answers.append(output)
+                if pairs != None and not self.__decided(self.__check(validation, output, context), context):
+                    for gradingQuestion in validation.evalOneOfs:
+                        pairs.put((output, gradingQuestion))
+        
+        try:
+            with context.profiler.stage("generation"):
+                self.__generate(model, tokenizer, encoded, context.device, context.vBatchSize, context, onBatch, stops,
+                                groups = [entry.userPromptType for _, entry in jobs], **genArgs)
+        finally:
+            if worker != None:
+                pairs.put(None)
+                worker.join()
+        if worker != None and len(errors) > 0:
+            raise errors[0]
         
-        print("Asking " + str(dataset["validation"].num_rows * context.vPasses) + " questions...")
+        return result
+    
+    def __compile(self, tokenizer, context: Context):
+        # Validation records are loaded, templated and tokenized once and reused by every validation round
+        if self.compiled != None and self.compiled[0] == tokenizer.name_or_path:
+            return self.compiled[1]
+        
+        dataset = Dataset().loadDataDir("json", context.locValidation, context)
         
-        noQuestion = 0
-        result.total = 0
+        compiled = []
         for record in dataset["validation"]:
-            answers = []
-            for _ in range(0, context.vPasses):
-                prompt = ""
-                userPromptType = ""
-                trimPrompt = True
-                
-                userPromptType = "chat"
+            prompt = ""
+            userPromptType = ""
+            trimPrompt = True
+            
+            userPromptType = "chat"
+            userPrompt = record[userPromptType]
+            if userPrompt:
+                chat = [
+                    {"role": "user", "content": f"{userPrompt}"}
+                ]
+                prompt = tokenizer.apply_chat_template(chat, add_generation_prompt = True, tokenize = False)
+            else:
+                userPromptType = "chatCompletion"
                 userPrompt = record[userPromptType]
                 if userPrompt:
                     chat = [
                         {"role": "user", "content": f"{userPrompt}"}
                     ]
-                    prompt = tokenizer.apply_chat_template(chat, add_generation_prompt = True, tokenize = False)
+                    prompt = tokenizer.apply_chat_template(chat, continue_final_message = True, tokenize = False)
                 else:
-                    userPromptType = "chatCompletion"
-                    userPrompt = record[userPromptType]
-                    if userPrompt:
-                        chat = [
-                            {"role": "user", "content": f"{userPrompt}"}
-                        ]
-                        prompt = tokenizer.apply_chat_template(chat, continue_final_message = True, tokenize = False)
-                    else:
-                        userPromptType = "completion"
-                        userPrompt = prompt = record[userPromptType]
-                        trimPrompt = False
-                        if not userPrompt:
-                            continue
-                
-                tokenized = tokenizer(prompt, return_tensors="pt", return_attention_mask = True, add_special_tokens = False).to(context.device)
-                
-                outputs = model.generate(**tokenized, max_new_tokens = context.vGenMaxTokens, pad_token_id = tokenizer.eos_token_id)
-                
-                output = str(tokenizer.decode(outputs[0]))
-                if trimPrompt:
-                    output = output.replace(prompt, "")
+                    userPromptType = "completion"
+                    userPrompt = prompt = record[userPromptType]
+                    trimPrompt = False
+            
+            inputIds = tokenizer(prompt, add_special_tokens = False)["input_ids"] if userPrompt else None
+            compiled.append(CompiledValidation(userPrompt, userPromptType, prompt, inputIds, trimPrompt,
+                                               record["oneOf"] or [], record["string"] or [],
+                                               record.get("regex") or [], record.get("exact") or [], record.get("similar") or []))
+        
+        self.compiled = (tokenizer.name_or_path, compiled)
+        return compiled
+    
+    def __generate(self, model, tokenizer, encoded, device, batchSize, context: Context, onBatch = None, stops = None, closeJson = False,
+                   groups = None, **kwargs):
+        # Returns the generated continuation of each prompt, without eos and padding
+        # Prompts of a group (e.g. a prompt type) share their chat template prefix (the grader additionally its system prompt).
+        # It is prefilled once per group and its key/values are reused by every batch of the group, only the remainder
+        # of each prompt is encoded by generate
+        groups = groups or [None] * len(encoded)
+        batches = []
+        for group in dict.fromkeys(groups):
+            members = [i for i in range(len(encoded)) if groups[i] == group]
+            prefix = self.__commonPrefix([encoded[i] for i in members]) if context.vPrefixCache else []
+            prefixCache = self.__prefill(model, prefix, device)
+            if prefixCache != None:
+                print(f"Reusing {len(prefix)} prefix tokens of {len(members)} prompts" + (f" ({group})" if group != None else ""))
+            
+            # Prompts of similar length share a batch to keep the left padding short
+            members.sort(key = lambda i: len(encoded[i]))
+            batches += [(members[start : start + batchSize], prefix, prefixCache) for start in range(0, len(members), batchSize)]
+        
+        outputs = [None] * len(encoded)
+        noPrompt = 0
+        for batchNo, (batch, prefix, prefixCache) in enumerate(batches):
+            # Padding sits between prefix and remainder, the positions of the remainder are derived from the attention mask
+            suffixes = [encoded[i][len(prefix):] for i in batch]
+            width = max(len(suffix) for suffix in suffixes)
+            padding = [width - len(suffix) for suffix in suffixes]
+            inputIds = torch.tensor([prefix + [tokenizer.pad_token_id] * pad + suffix for pad, suffix in zip(padding, suffixes)], device = device)
+            attentionMask = torch.tensor([[1] * len(prefix) + [0] * pad + [1] * len(suffix) for pad, suffix in zip(padding, suffixes)], device = device)
+            
+            genArgs = {}
+            if (stops != None and any(len(stops[i]) > 0 for i in batch)) or closeJson:
+                genArgs["stopping_criteria"] = StoppingCriteriaList([StopCriteria(
+                        tokenizer, inputIds.shape[1], [stops[i] if stops != None else [] for i in batch], closeJson)])
+            if prefixCache != None:
+                genArgs["past_key_values"] = DynamicCache.from_legacy_cache(tuple(
+                        (key.expand(len(batch), -1, -1, -1), value.expand(len(batch), -1, -1, -1)) for key, value in prefixCache))
+            
+            generated = model.generate(input_ids = inputIds, attention_mask = attentionMask, max_new_tokens = context.vGenMaxTokens,
+                                       pad_token_id = tokenizer.pad_token_id, **genArgs, **kwargs)
+            context.profiler.count((generated[:, inputIds.shape[1]:] != tokenizer.pad_token_id).sum())
+            
+            # Only tokens after the prompt are decoded
+            for i, output in zip(batch, tokenizer.batch_decode(generated[:, inputIds.shape[1]:])):
                 if tokenizer.eos_token:
                     output = output.replace(tokenizer.eos_token, "")
                 if tokenizer.pad_token:
-                    output = output.replace(tokenizer.pad_token, "").rstrip()
-                
-                answers.append(output)
-                
-                noQuestion += 1
-                print(noQuestion, end = " " if noQuestion%10>0 else "\n", flush = True)
-                
-            result.total += len(answers) * (len(record["oneOf"] or []) + len(record["string"] or []))
-            result.validations.append(Validation(userPrompt, userPromptType, answers, record["oneOf"], record["string"]))
+                    output = output.replace(tokenizer.pad_token, "")
+                outputs[i] = str(output).rstrip()
+            if onBatch != None:
+                onBatch(batch, [outputs[i] for i in batch])
             
+            noPrompt += len(batch)
+            print(f"{noPrompt}/{len(encoded)}", end = " " if (batchNo + 1) % 10 > 0 else "\n", flush = True)
+        
         print("")
         
-        return result
+        return outputs
     
-    def __loadGraderModel(self, context: Context):
+    def __prefill(self, model, prefix, device):
+        if len(prefix) == 0:
+            return None
+        with torch.no_grad():
+            prefixCache = model(input_ids = torch.tensor([prefix], device = device), use_cache = True).past_key_values
+        if hasattr(prefixCache, "to_legacy_cache"):
+            prefixCache = prefixCache.to_legacy_cache()
+        # Outputs of a model prepared for mixed precision training are upcast to float32
+        dtype = model.get_input_embeddings().weight.dtype
+        return tuple((key.to(dtype), value.to(dtype)) for key, value in prefixCache)
+    
+    def __truncate(self, output, stops):
+        # Answers end before the first stop string
+        positions = [output.index(stop) for stop in stops if stop in output]
+        return output[:min(positions)] if len(positions) > 0 else output
+    
+    def __commonPrefix(self, encoded):
+        # Every prompt keeps at least one token of its own to start generation from
+        prefix = min(encoded, key = len)[:-1]
+        for ids in encoded:
+            length = 0
+            while length < len(prefix) and ids[length] == prefix[length]:
+                length += 1
+            prefix = prefix[:length]
+        return prefix
+    
+    def __loadGraderTokenizer(self, context: Context):
+        if self.graderTokenizer != None:
+            return
         self.graderTokenizer = AutoTokenizer.from_pretrained(context.locGraderModel, trust_remote_code = True)
         if self.graderTokenizer.pad_token == None:
             self.graderTokenizer.pad_token = self.graderTokenizer.eos_token
-        self.graderModel = ModelLoader().load(context.locGraderModel, context.vGraderOnCpu, context.vQuantGrader, context)
     
-    def __grade(self, validations, context: Context):
+    def __loadGraderModel(self, context: Context):
+        self.__loadGraderTokenizer(context)
+        if self.graderModel == None:
+            self.graderModel = ModelLoader().load(context.locGraderModel, context.vGraderOnCpu, context.vQuantGrader, context, context.vQuantGrader)
+    
+    def __grade(self, validations, context: Context, verdicts: dict = None):
         print("Grading...")
         
+        # Deterministic checks run first, the grader only sees answers they leave undecided
+        checks = [[self.__check(validation, answer, context) for answer in validation.answers] for validation in validations.validations]
+        verdicts = self.__gradeQueue(validations, checks, verdicts or {}, context)
+        
         cntEvaluations = 0
         cntPassed = 0
         cntValidations = 0
         cntCompletion = 0
         
-        for validation in validations.validations:
+        for validation, answerChecks in zip(validations.validations, checks):
             cntCompletion += 1
             print(f"{validation.userPromptType} {cntCompletion}/{len(validations.validations)}: {validation.userPrompt}")
             
-            for answer in validation.answers:
+            for answer, answerCheck in zip(validation.answers, answerChecks):
                 print(f"    * {answer}")
                 
-                if len(validation.evalOneOfs) > 0:
+                if len(validation.evalOneOfs) > 0 and self.__decided(answerCheck, context):
+                    # Not counted, the passed check is the answer's only evaluation
+                    cntValidations += len(validation.evalOneOfs)
+                    print(f"        > ({cntValidations}/{validations.total}) Grading questions skipped, decided by deterministic checks")
+                
+                elif len(validation.evalOneOfs) > 0:
                     cntEvaluations += 1
                     passed = False
                     for gradingQuestion in validation.evalOneOfs:
                         cntValidations += 1
                         print(f"        > ({cntValidations}/{validations.total}) {gradingQuestion}")
                         
-                        chat = [
-                            {"role": "system", "content": """You are a grader that evaluates the relevance of a given text to a user question.
-Please provide a binary response 'true' or 'false' for the following text.
-'true' means that the text provides a truthful answer to the question, while 'false' means that it does not.
-Provide no preamble and a short explanation. Return the response in JSON format with the following field: "passed", "explanation\""""},
-                            {"role": "user", "content": f"""The text is: '{answer}'
-The question is: '{gradingQuestion}'"""}
-                        ]
-                        prompt = self.graderTokenizer.apply_chat_template(chat, add_generation_prompt = True, tokenize = False)
-                        tokenized = self.graderTokenizer(prompt, return_tensors="pt", return_attention_mask = True, add_special_tokens = False)
-                        if not context.vGraderOnCpu:
-                            tokenized = tokenized.to(context.device)
-                        
-                        outputs = self.graderModel.generate(**tokenized, max_new_tokens = context.vGenMaxTokens, pad_token_id = self.graderTokenizer.eos_token_id)
-                        
-                        output = self.graderTokenizer.decode(outputs[0])
-                        output = output.replace(prompt, "")
-                        if self.graderTokenizer.eos_token:
-                            output = output.replace(self.graderTokenizer.eos_token, "")
-                        if self.graderTokenizer.pad_token:
-                            output = output.replace(self.graderTokenizer.pad_token, "").rstrip()
-                        
-                        questionPassed = False
-                        try:
-                            processed = output[output.index("{") : output.index("}") + 1]
-                            print(processed)
-                            parsed = json.loads(processed)
-                            questionPassed = "true" in str(parsed["passed"]).lower()
-                            
-                        except:
-                            if "\"passed\"" in output.lower():
-                                print(output)
-                                print(f"            -> Warning: Json malformed but parseable")
-                                questionPassed = any(field in output.lower() for field in ("\"passed\": true", "\"passed\":true", "\"passed\": \"true\"", "\"passed\":\"true\"")) 
-                                
-                            else:
-                                print(f"            -> ERROR: Cannot parse: {output}")
+                        questionPassed, log = verdicts[(answer, gradingQuestion)]
+                        if log:
+                            print(log)
                         
                         passed |= questionPassed
                         print("            -> " + ("PASSED" if questionPassed else "FAILED"))
@@ -199,13 +398,13 @@ The question is: '{gradingQuestion}'"""}
                     if passed:
                         cntPassed += 1
                 
-                if len(validation.evalStrings) > 0:
+                if len(answerCheck) > 0:
                     cntEvaluations += 1
                     passed = False
-                    for evalString in validation.evalStrings:
+                    for description, checkPassed in answerCheck:
                         cntValidations += 1
-                        print(f"        > ({cntValidations}/{validations.total}) Contains string {evalString}")
-                        passed |= evalString.lower() in answer.lower()
+                        print(f"        > ({cntValidations}/{validations.total}) {description}")
+                        passed |= checkPassed
                     print("        => " + ("PASSED" if passed else "FAILED"))
                     if passed:
                         cntPassed += 1
@@ -213,20 +412,177 @@ The question is: '{gradingQuestion}'"""}
         passedPerc = int(float(cntPassed) / float(cntEvaluations) * 100.0)
         result = passedPerc >= context.vExpected
         self.statistics.append((result, passedPerc))
+        context.results["passRate"] = passedPerc
         
         print("")
         print("#############")
         print("Final result: " + str(cntPassed) + "/" + str(cntEvaluations) + " -> " + str(passedPerc) + "%")
+        if context.vGradingCache:
+            self.__keepGradingStatistics(validations)
+            print(f"Grading cache: {validations.cacheHits} hits, {validations.cacheMisses} misses")
         print("--> " + ("PASSED" if result else "FAILED"))
         
         return result
     
+    def __gradeQueue(self, validations, checks, verdicts: dict, context: Context):
+        # Every distinct (answer, grading question) pair is graded exactly once, pairs graded while generating are skipped
+        queue = []
+        for validation, answerChecks in zip(validations.validations, checks):
+            for answer, answerCheck in zip(validation.answers, answerChecks):
+                if self.__decided(answerCheck, context):
+                    continue
+                for gradingQuestion in validation.evalOneOfs:
+                    if (answer, gradingQuestion) not in verdicts:
+                        queue.append((answer, gradingQuestion))
+        queue = list(dict.fromkeys(queue))
+        
+        if len(queue) == 0:
+            return verdicts
+        
+        with context.profiler.stage("grading"):
+            verdicts.update(self.__gradePairs(queue, context))
+        
+        return verdicts
+    
+    def __gradeWorker(self, pairs, verdicts: dict, errors: list, context: Context):
+        # Consumes answers in batches of vGraderBatchSize until the end marker None arrives.
+        # After an error the queue is still drained, so the generating thread never blocks on it
+        with context.profiler.stage("grading"):
+            finished = False
+            while not finished:
+                batch = [pairs.get()]
+                while len(batch) < context.vGraderBatchSize and batch[-1] != None:
+                    try:
+                        batch.append(pairs.get_nowait())
+                    except queue.Empty:
+                        break
+                finished = batch[-1] == None
+                batch = [pair for pair in dict.fromkeys(batch) if pair != None and pair not in verdicts]
+                if len(batch) == 0 or len(errors) > 0:
+                    continue
+                try:
+                    verdicts.update(self.__gradePairs(batch, context))
+                except Exception as e:
+                    errors.append(e)
+    
+    def __resetGradingStatistics(self):
+        # Statistics are counted per validation round
+        if self.gradingCache != None:
+            self.gradingCache.resetStatistics()
+    
+    def __keepGradingStatistics(self, validations):
+        if self.gradingCache != None:
+            validations.cacheHits += self.gradingCache.hits
+            validations.cacheMisses += self.gradingCache.misses
+            self.gradingCache.resetStatistics()
+    
+    def __gradePairs(self, queue, context: Context):
+        verdicts = {}
+        self.__openGradingCache(context)
+        if self.gradingCache != None:
+            pending = []
+            for answer, gradingQuestion in queue:
+                cached = self.gradingCache.get(answer, gradingQuestion)
+                if cached != None:
+                    verdicts[(answer, gradingQuestion)] = cached
+                else:
+                    pending.append((answer, gradingQuestion))
+            queue = pending
+        
+        if len(queue) == 0:
+            return verdicts
+        
+        print(f"Grading {len(queue)} answers...")
+        
+        # The grader model is only loaded when answers are left to grade
+        self.__loadGraderModel(context)
+        
+        encoded = [self.graderTokenizer(self.__graderPrompt(answer, gradingQuestion), add_special_tokens = False)["input_ids"]
+                   for answer, gradingQuestion in queue]
+        device = None if context.vGraderOnCpu else context.device
+        outputs = self.__generate(self.graderModel, self.graderTokenizer, encoded, device, context.vGraderBatchSize, context,
+                                  closeJson = context.vGraderStopJson)
+        
+        for key, output in zip(queue, outputs):
+            verdicts[key] = self.__parseGrading(output)
+            if self.gradingCache != None:
+                self.gradingCache.put(*key, verdicts[key])
+        
+        if self.gradingCache != None:
+            self.gradingCache.commit()
+        
+        return verdicts
+    
+    def __openGradingCache(self, context: Context):
+        self.__loadGraderTokenizer(context)
+        if context.vGradingCache and self.gradingCache == None:
+            self.gradingCache = GradingCache(os.path.join(context.locWorkdir, "grading_cache.sqlite"),
+                                             context.locGraderModel,
+                                             self.__graderPrompt("{answer}", "{question}") + str(context.vGenMaxTokens),
+                                             context.vGradingCacheSize)
+    
+    def __check(self, validation, answer, context: Context):
+        checks = []
+        for evalString in validation.evalStrings:
+            checks.append((f"Contains string {evalString}", evalString.lower() in answer.lower()))
+        for evalRegex in validation.evalRegexes:
+            checks.append((f"Matches regex {evalRegex}", re.search(evalRegex, answer) != None))
+        for evalExact in validation.evalExacts:
+            checks.append((f"Equals {evalExact}", self.__normalise(evalExact) == self.__normalise(answer)))
+        for evalSimilar in validation.evalSimilars:
+            overlap = self.__overlap(evalSimilar, answer)
+            checks.append((f"Token overlap {overlap:.2f} with {evalSimilar}", overlap >= context.vSimilarity))
+        return checks
+    
+    def __decided(self, answerCheck, context: Context):
+        # The grading questions of an answer that passed a deterministic check are skipped
+        return context.vStagedGrading and any(passed for _, passed in answerCheck)
+    
+    def __normalise(self, text):
+        return " ".join(text.lower().translate(str.maketrans("", "", string.punctuation)).split())
+    
+    def __overlap(self, reference, answer):
+        # F1 score of the shared tokens
+        referenceTokens = self.__normalise(reference).split()
+        answerTokens = self.__normalise(answer).split()
+        common = sum(min(referenceTokens.count(token), answerTokens.count(token)) for token in set(referenceTokens))
+        if common == 0:
+            return 0.0
+        precision = common / len(answerTokens)
+        recall = common / len(referenceTokens)
+        return 2 * precision * recall / (precision + recall)
+    
+    def __graderPrompt(self, answer, gradingQuestion):
+        chat = [
+            {"role": "system", "content": """You are a grader that evaluates the relevance of a given text to a user question.
+Please provide a binary response 'true' or 'false' for the following text.
+'true' means that the text provides a truthful answer to the question, while 'false' means that it does not.
+Provide no preamble and a short explanation. Return the response in JSON format with the following field: "passed", "explanation\""""},
+            {"role": "user", "content": f"""The text is: '{answer}'
+The question is: '{gradingQuestion}'"""}
+        ]
+        return self.graderTokenizer.apply_chat_template(chat, add_generation_prompt = True, tokenize = False)
+    
+    def __parseGrading(self, output):
+        try:
+            processed = output[output.index("{") : output.index("}") + 1]
+            parsed = json.loads(processed)
+            return "true" in str(parsed["passed"]).lower(), processed
+            
+        except:
+            if "\"passed\"" in output.lower():
+                questionPassed = any(field in output.lower() for field in ("\"passed\": true", "\"passed\":true", "\"passed\": \"true\"", "\"passed\":\"true\""))
+                return questionPassed, f"{output}\n            -> Warning: Json malformed but parseable"
+                
+            else:
+                return False, f"            -> ERROR: Cannot parse: {output}"
+    
     def unload(self, context: Context):
         if self.peftTokenizer != None:
             del self.peftTokenizer
             self.peftTokenizer = None
+        # Models stay resident in the ModelLoader until their memory is needed
         if self.peftModel != None:
-            self.peftModel.unload()
             del self.peftModel
             self.peftModel = None
         if self.graderTokenizer != None:
@@ -235,6 +591,9 @@ The question is: '{gradingQuestion}'"""}
         if self.graderModel != None:
             del self.graderModel
             self.graderModel = None
+        if self.gradingCache != None:
+            self.gradingCache.close()
+            self.gradingCache = None
         self.statistics = []
         
         gc.collect()
@@ -246,6 +605,21 @@ The question is: '{gradingQuestion}'"""}
 class Validations:
     validations: list
     total: int
+    cacheHits: int = 0
+    cacheMisses: int = 0
+
+@dataclass
+class CompiledValidation:
+    userPrompt: str
+    userPromptType: str
+    prompt: str
+    inputIds: list
+    trimPrompt: bool
+    evalOneOfs: list
+    evalStrings: list
+    evalRegexes: list
+    evalExacts: list
+    evalSimilars: list
 
 @dataclass
 class Validation:
@@ -254,3 +628,6 @@ class Validation:
     answers: list
     evalOneOfs: list
     evalStrings: list
+    evalRegexes: list
+    evalExacts: list
+    evalSimilars: list